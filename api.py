@@ -0,0 +1,28 @@
+# The LAMP client's API objects (LAMP.Type, LAMP.ActivityEvent, ...) that every module calls through the LAMP module.
+API_NAMES = ['API', 'Type', 'Credential', 'Researcher', 'Study', 'Participant', 'Activity', 'ActivitySpec', 'ActivityEvent', 'Sensor', 'SensorSpec', 'SensorEvent']
+
+# Helper class that stands in for one LAMP API object and routes each of its calls through a middleware function,
+# called as middleware(operation, function, args, kwargs) with the operation named like "ActivityEvent.all_by_participant".
+class Api:
+    def __init__(self, api, name, middleware):
+        self.api = api
+        self.name = name
+        self.middleware = middleware
+
+    def __getattr__(self, method):
+        function = getattr(self.api, method)
+        if not callable(function):
+            return function
+        operation = f"{self.name}.{method}"
+        def call(*args, **kwargs):
+            return self.middleware(operation, function, args, kwargs)
+        return call
+
+# Route every call made through the LAMP module's API objects through the middleware. Installing several middlewares
+# nests them, with the last one installed running first.
+# NOTE: LAMP.connect() replaces the API objects, so this must be called after connecting.
+def install(module, middleware):
+    for name in API_NAMES:
+        api = getattr(module, name, None)
+        if api is not None:
+            setattr(module, name, Api(api, name, middleware))
@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import socket
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import LAMP
+
+log = logging.getLogger(__name__)
+
+# Helper class that writes Tags (LAMP.Type.set_attachment) behind the caller's back. Each write is appended to a local
+# outbox table (shared by all processes through the event store) before write() returns, so a crash never loses it,
+# and the outbox is flushed a few seconds later by `threads` concurrent writers. Since every write replaces the whole
+# value, only the latest pending value of each (owner, target, key) is sent, however often it was updated meanwhile.
+# A failed write stays in the outbox and is retried with exponential backoff. Writes of the same Tag are serialized
+# across processes by a claim on it, so an older value can never overwrite a newer one; claims of a crashed process
+# expire after `claim_ttl` seconds. Use read() instead of LAMP.Type.get_attachment for Tags that may have pending writes.
+class AttachmentWriter:
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS attachment_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner TEXT NOT NULL,
+            target TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            queued_at INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt INTEGER NOT NULL DEFAULT 0
+        )""",
+        'CREATE INDEX IF NOT EXISTS attachment_outbox_by_key ON attachment_outbox (owner, target, key, id)',
+        """CREATE TABLE IF NOT EXISTS attachment_claims (
+            owner TEXT NOT NULL,
+            target TEXT NOT NULL,
+            key TEXT NOT NULL,
+            holder TEXT NOT NULL,
+            expires INTEGER NOT NULL,
+            PRIMARY KEY (owner, target, key)
+        )""",
+    ]
+
+    def __init__(self, store, threads=4, delay=5, retry=30, max_retry=60 * 60, claim_ttl=60):
+        self.store = store
+        self.threads = threads
+        self.delay = delay
+        self.retry = retry
+        self.max_retry = max_retry
+        self.claim_ttl = claim_ttl
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{id(self)}"
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.timer = None
+        with self.store.connection() as db:
+            for statement in self.SCHEMA:
+                db.execute(statement)
+
+    # Queue the Tag write, exactly like LAMP.Type.set_attachment(owner, target, key, value).
+    def write(self, owner, target, key, value):
+        with self.store.connection() as db:
+            db.execute('INSERT INTO attachment_outbox (owner, target, key, value, queued_at) VALUES (?, ?, ?, ?, ?)', (owner, target, key, json.dumps(value), int(time.time() * 1000)))
+        self.schedule(self.delay)
+
+    # The Tag's latest value, including a pending write, exactly like LAMP.Type.get_attachment(type_id, key)['data'].
+    def read(self, type_id, key):
+        row = self.store.connection().execute(
+            "SELECT value FROM attachment_outbox WHERE key = ? AND (target = ? OR (target = 'me' AND owner = ?)) ORDER BY id DESC LIMIT 1",
+            (key, type_id, type_id)
+        ).fetchone()
+        if row is not None:
+            return json.loads(row[0])
+        return LAMP.Type.get_attachment(type_id, key)['data']
+
+    def pending(self):
+        return self.store.connection().execute('SELECT COUNT(*) FROM attachment_outbox').fetchone()[0]
+
+    def schedule(self, delay):
+        with self.lock:
+            if self.timer is None:
+                self.timer = threading.Timer(delay, self.scheduled_flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def scheduled_flush(self):
+        with self.lock:
+            self.timer = None
+        try:
+            self.flush()
+        except:
+            log.exception("Could not flush the attachment outbox.")
+
+        # Come back for writes that are waiting to be retried (or that another process is sending right now).
+        row = self.store.connection().execute('SELECT MIN(next_attempt) FROM attachment_outbox').fetchone()
+        if row[0] is not None:
+            self.schedule(max(row[0] / 1000 - time.time(), self.delay))
+
+    # Send the latest pending value of every Tag that is due and return how many Tags were written. With sequential=True
+    # they are sent one by one from the calling thread, since no new threads can be started while the interpreter exits.
+    def flush(self, sequential=False):
+        with self.flush_lock:
+            now = int(time.time() * 1000)
+            due = self.store.connection().execute(
+                'SELECT owner, target, key FROM attachment_outbox GROUP BY owner, target, key HAVING MIN(next_attempt) <= ?', (now,)
+            ).fetchall()
+            if len(due) == 0:
+                return 0
+            if sequential:
+                written = sum(self.deliver(*x) for x in due)
+            else:
+                with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                    written = sum(executor.map(lambda x: self.deliver(*x), due))
+            log.info(f"Wrote {written} of {len(due)} pending Tags from the attachment outbox.")
+            return written
+
+    # Stop the scheduled flushes and send what is due one last time (i.e. at exit); whatever is left stays in the outbox
+    # for the next process.
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        try:
+            self.flush(sequential=True)
+        except:
+            log.exception("Could not flush the attachment outbox; its writes will be sent by the next process.")
+
+    def deliver(self, owner, target, key):
+        if not self.claim(owner, target, key):
+            return 0
+        db = self.store.connection()
+        try:
+            row = db.execute('SELECT id, value FROM attachment_outbox WHERE owner = ? AND target = ? AND key = ? ORDER BY id DESC LIMIT 1', (owner, target, key)).fetchone()
+            if row is None:
+                return 0 # Already written by another process.
+            try:
+                LAMP.Type.set_attachment(owner, target, key, json.loads(row[1]))
+            except:
+                log.exception(f"Could not write Tag {key} of {target} ({owner}); it will be retried.")
+                with db:
+                    db.execute('UPDATE attachment_outbox SET attempts = attempts + 1 WHERE owner = ? AND target = ? AND key = ?', (owner, target, key))
+                    attempts = db.execute('SELECT MAX(attempts) FROM attachment_outbox WHERE owner = ? AND target = ? AND key = ?', (owner, target, key)).fetchone()[0]
+                    backoff = min(self.retry * 2 ** (attempts - 1), self.max_retry)
+                    db.execute('UPDATE attachment_outbox SET next_attempt = ? WHERE owner = ? AND target = ? AND key = ?', (int((time.time() + backoff) * 1000), owner, target, key))
+                return 0
+            with db:
+                db.execute('DELETE FROM attachment_outbox WHERE owner = ? AND target = ? AND key = ? AND id <= ?', (owner, target, key, row[0]))
+            return 1
+        finally:
+            with db:
+                db.execute('DELETE FROM attachment_claims WHERE owner = ? AND target = ? AND key = ? AND holder = ?', (owner, target, key, self.holder))
+
+    def claim(self, owner, target, key):
+        now = int(time.time() * 1000)
+        with self.store.connection() as db:
+            db.execute('DELETE FROM attachment_claims WHERE owner = ? AND target = ? AND key = ? AND expires < ?', (owner, target, key, now))
+            claimed = db.execute('INSERT OR IGNORE INTO attachment_claims (owner, target, key, holder, expires) VALUES (?, ?, ?, ?, ?)', (owner, target, key, self.holder, now + self.claim_ttl * 1000)).rowcount
+        return claimed == 1
@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_lamp
+from fake_gateway import FakeGateway
+
+# End-to-end benchmark of the automations worker and the summary page against the local LAMP stand-in and push
+# gateway: a cold worker pass (empty event store), a warm pass with no new data, an incremental pass after a day of new
+# data, and then logins to the summary page. Prints (and optionally writes) one JSON document so runs can be compared.
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))] if len(values) > 0 else None
+
+def peak_memory_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def worker_pass(main, gateway, participants):
+    fake_lamp.reset_calls()
+    gateway.reset()
+    started = time.perf_counter()
+    main.automations_worker()
+    elapsed = time.perf_counter() - started
+    main.DELIVERY.flush(60)
+    return {
+        'seconds': round(elapsed, 3),
+        'per_participant_ms': round(1000 * elapsed / max(participants, 1), 3),
+        'api_calls': fake_lamp.reset_calls(),
+        'deliveries': gateway.reset(),
+    }
+
+def timed_requests(client, participants, requests, rng):
+    page, spec = [], []
+    for _ in range(requests):
+        participant = rng.choice(participants)
+        started = time.perf_counter()
+        response = client.post('/summary', data={'email': fake_lamp.DATA['credentials'][participant], 'password': participant})
+        page.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.status_code
+        token = response.get_data(as_text=True).split('/summary/spec?token=', 1)[1].split("'", 1)[0]
+        started = time.perf_counter()
+        response = client.get(f"/summary/spec?token={token}")
+        spec.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.status_code
+    return {
+        'page_p50_ms': round(1000 * percentile(page, 0.5), 3),
+        'page_p99_ms': round(1000 * percentile(page, 0.99), 3),
+        'spec_p50_ms': round(1000 * percentile(spec, 0.5), 3),
+        'spec_p99_ms': round(1000 * percentile(spec, 0.99), 3),
+        'spec_bytes': len(response.get_data()),
+        'api_calls': fake_lamp.reset_calls(),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the automations worker and /summary against a local LAMP stand-in.")
+    parser.add_argument('--studies', type=int, default=2)
+    parser.add_argument('--participants', type=int, default=100, help="per study")
+    parser.add_argument('--days', type=int, default=56, help="days of history per participant")
+    parser.add_argument('--analytics', type=int, default=50, help="lamp.analytics events per participant")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every LAMP API call")
+    parser.add_argument('--latency-per-item', type=float, default=0.0, help="seconds added per returned item")
+    parser.add_argument('--page-limit', type=int, help="maximum events per LAMP API response")
+    parser.add_argument('--lamp-rate', type=float, help="initial LAMP API rate limit (calls/s; the app's default if not set)")
+    parser.add_argument('--gateway-latency', type=float, default=0.0, help="seconds added to every push gateway request")
+    parser.add_argument('--worker-threads', type=int, default=8)
+    parser.add_argument('--summary-requests', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench_e2e_')
+    gateway = FakeGateway(latency=args.gateway_latency).start()
+    os.environ.update({
+        'APP_NAME': 'bench', 'RESEARCHER_ID': fake_lamp.RESEARCHER_ID, 'PUSH_GATEWAY': 'localhost', 'DEBUG_MODE': 'off',
+        'WORKER_THREADS': str(args.worker_threads), 'EVENT_STORE_PATH': os.path.join(directory, 'bench.db'),
+        'STUDY_START': time.strftime('%Y-%m-%d', time.gmtime(time.time() - (args.days + 1) * 24 * 60 * 60)),
+    })
+    if args.page_limit is not None:
+        os.environ['LAMP_PAGE_LIMIT'] = str(args.page_limit)
+    if args.lamp_rate is not None:
+        os.environ['LAMP_RATE'] = os.environ['LAMP_MAX_RATE'] = str(args.lamp_rate)
+    fake_lamp.generate(args.studies, args.participants, args.days, args.analytics, seed=args.seed)
+    fake_lamp.LATENCY, fake_lamp.LATENCY_PER_ITEM = args.latency, args.latency_per_item
+    fake_lamp.PAGE_LIMIT = args.page_limit
+    sys.modules['LAMP'] = fake_lamp
+    import main
+    logging.getLogger().setLevel(logging.WARNING)
+    main.DELIVERY.url = gateway.url
+    random.seed(args.seed)
+
+    participants = sorted(fake_lamp.DATA['participants'])
+    results = {
+        'benchmark': 'e2e',
+        'revision': revision(),
+        'python': platform.python_version(),
+        'parameters': vars(args),
+        'events': sum(len(x) for x in fake_lamp.DATA['activity_events'].values()),
+    }
+    results['worker_cold'] = worker_pass(main, gateway, len(participants))
+    results['worker_warm'] = worker_pass(main, gateway, len(participants))
+    fake_lamp.advance(1, seed=args.seed + 1)
+    results['worker_incremental'] = worker_pass(main, gateway, len(participants))
+    results['summary'] = timed_requests(main.app.test_client(), participants, args.summary_requests, random.Random(args.seed))
+    results['peak_memory_mb'] = peak_memory_mb()
+    gateway.stop()
+
+    print(json.dumps(results))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
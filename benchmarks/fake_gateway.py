@@ -0,0 +1,50 @@
+import json
+import time
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A local push gateway that accepts the JSON bodies posted to /push (push notifications, emails and Slack messages)
+# after an optional delay, and counts them by kind. Start it with `start()` and point the app's DeliveryQueue at `url`.
+class FakeGateway:
+    def __init__(self, latency=0.0, port=0):
+        self.latency = latency
+        self.received = Counter()
+        self.lock = threading.Lock()
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                token = str(body.get('device_token', ''))
+                kind = token.split(':', 1)[0] if ':' in token else 'other'
+                with gateway.lock:
+                    gateway.received[kind] += 1
+                if gateway.latency > 0:
+                    time.sleep(gateway.latency)
+                response = json.dumps({'success': True}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/push"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='fake-gateway', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def reset(self):
+        with self.lock:
+            received = dict(self.received)
+            self.received.clear()
+        return received
@@ -0,0 +1,207 @@
+import json
+import time
+import random
+import threading
+from collections import Counter
+
+# A local stand-in for the LAMP client module, holding a synthetic researcher with any number of studies and
+# Participants. Install it before importing the app, i.e. `sys.modules['LAMP'] = fake_lamp`; every module that calls
+# `LAMP.<Api>.<method>(...)` then talks to it instead of the platform. Each call is counted in CALLS and can be slowed
+# down by a fixed LATENCY (seconds) plus LATENCY_PER_ITEM for every item returned, to approximate network transfer.
+# Results go through a JSON round trip like real responses, and PAGE_LIMIT (if set) caps how many (newest) events a
+# single event query returns, as the platform does.
+
+RESEARCHER_ID = 'fake-researcher'
+MILLISECONDS_PER_DAY = 24 * 60 * 60 * 1000
+
+LATENCY = 0.0
+LATENCY_PER_ITEM = 0.0
+PAGE_LIMIT = None
+
+CALLS = Counter()
+CALLS_LOCK = threading.Lock()
+DATA = {'studies': [], 'activities': {}, 'participants': {}, 'activity_events': {}, 'sensor_events': {}, 'tags': {}, 'credentials': {}}
+DATA_LOCK = threading.RLock()
+
+class ApiException(Exception):
+    def __init__(self, status=None, reason=None):
+        super().__init__(f"({status}) {reason}")
+        self.status = status
+        self.reason = reason
+
+def connect(access_key=None, secret_key=None, server_address=None):
+    pass
+
+def respond(name, value, items=1):
+    if name is None:
+        return {'data': value} # An internal query of another call.
+    with CALLS_LOCK:
+        CALLS[name] += 1
+    if LATENCY > 0 or LATENCY_PER_ITEM > 0:
+        time.sleep(LATENCY + LATENCY_PER_ITEM * items)
+    return {'data': json.loads(json.dumps(value))}
+
+def query(events, name, origin=None, _from=None, to=None, transform=None):
+    result = [
+        x for x in events
+        if (_from is None or x['timestamp'] >= _from) and (to is None or x['timestamp'] <= to)
+        and (origin is None or x.get('activity', x.get('sensor')) == origin)
+    ]
+    if PAGE_LIMIT is not None:
+        result = result[:PAGE_LIMIT]
+    return respond(name, result, len(result))
+
+class StudyApi:
+    def all_by_researcher(self, researcher_id):
+        return respond('Study.all_by_researcher', DATA['studies'], len(DATA['studies']))
+
+class ActivityApi:
+    def all_by_study(self, study_id):
+        return respond('Activity.all_by_study', DATA['activities'][study_id], len(DATA['activities'][study_id]))
+
+    def all_by_participant(self, participant_id):
+        study_id = DATA['participants'][participant_id]
+        return respond('Activity.all_by_participant', DATA['activities'][study_id], len(DATA['activities'][study_id]))
+
+class ParticipantApi:
+    def all_by_study(self, study_id):
+        participants = [{'id': x} for x, study in DATA['participants'].items() if study == study_id]
+        return respond('Participant.all_by_study', participants, len(participants))
+
+    def create(self, study_id, participant):
+        with DATA_LOCK:
+            participant_id = f"U{random.randrange(10 ** 9):09d}"
+            DATA['participants'][participant_id] = study_id
+            DATA['activity_events'][participant_id] = []
+            DATA['sensor_events'][participant_id] = []
+        return respond('Participant.create', {'id': participant_id})
+
+class ActivityEventApi:
+    def all_by_participant(self, participant_id, origin=None, _from=None, to=None, transform=None):
+        return query(DATA['activity_events'].get(participant_id, []), 'ActivityEvent.all_by_participant', origin, _from, to)
+
+    # Grouped by Participant, like the platform: [{'id': participant_id, 'data': [events]}].
+    def all_by_study(self, study_id, origin=None, _from=None, to=None, transform=None):
+        groups = [
+            {'id': participant_id, 'data': query(DATA['activity_events'].get(participant_id, []), None, origin, _from, to)['data']}
+            for participant_id, study in list(DATA['participants'].items()) if study == study_id
+        ]
+        return respond('ActivityEvent.all_by_study', groups, sum(len(x['data']) for x in groups))
+
+class SensorEventApi:
+    def all_by_participant(self, participant_id, origin=None, _from=None, to=None, transform=None):
+        return query(DATA['sensor_events'].get(participant_id, []), 'SensorEvent.all_by_participant', origin, _from, to)
+
+class TypeApi:
+    def get_attachment(self, type_id, attachment_key):
+        with DATA_LOCK:
+            if (type_id, attachment_key) not in DATA['tags']:
+                respond('Type.get_attachment', None)
+                raise ApiException(404, 'Not Found')
+            value = DATA['tags'][(type_id, attachment_key)]
+        return respond('Type.get_attachment', value, len(value) if isinstance(value, (list, dict)) else 1)
+
+    def set_attachment(self, type_id, target, attachment_key, attachment_value):
+        with DATA_LOCK:
+            DATA['tags'][(type_id if target == 'me' else target, attachment_key)] = json.loads(json.dumps(attachment_value))
+        return respond('Type.set_attachment', {}, len(attachment_value) if isinstance(attachment_value, (list, dict)) else 1)
+
+class CredentialApi:
+    def list(self, type_id):
+        return respond('Credential.list', [{'origin': type_id, 'access_key': DATA['credentials'][type_id], 'description': "Generated Login"}])
+
+    def create(self, type_id, credential):
+        with DATA_LOCK:
+            DATA['credentials'][type_id] = credential['access_key']
+        return respond('Credential.create', {})
+
+Study = StudyApi()
+Activity = ActivityApi()
+Participant = ParticipantApi()
+ActivityEvent = ActivityEventApi()
+SensorEvent = SensorEventApi()
+Type = TypeApi()
+Credential = CredentialApi()
+
+DAILY_QUESTIONS = ["i was able to function well today", "today I could handle what came my way"] + [f"daily question {i}" for i in range(8)]
+WEEKLY_QUESTIONS = [f"phq-9 question {i}" for i in range(9)]
+
+def survey(activity_id, name, questions):
+    return {'id': activity_id, 'name': name, 'spec': 'lamp.survey', 'settings': [
+        {'text': text, 'type': 'likert', 'options': None} for text in questions
+    ]}
+
+def survey_event(activity_id, timestamp, questions, rng):
+    return {'activity': activity_id, 'timestamp': timestamp, 'duration': 60000, 'static_data': {}, 'temporal_slices': [
+        {'item': text, 'value': rng.choice(["0", "1", "2", "3", "3", None]), 'type': None, 'duration': 5000, 'level': None}
+        for text in questions
+    ]}
+
+# Synthesize one Participant's history ending now: a Daily Survey on most days, a Weekly Survey every week, occasional
+# journal entries, and `analytics` "lamp.analytics" SensorEvents (the most recent of which registers a device).
+def participant_history(study_id, days, analytics, rng, now):
+    events, start = [], now - days * MILLISECONDS_PER_DAY
+    for day in range(days):
+        timestamp = start + day * MILLISECONDS_PER_DAY + rng.randrange(MILLISECONDS_PER_DAY // 2)
+        if rng.random() < 0.9:
+            events.append(survey_event(f"{study_id}-daily", timestamp, DAILY_QUESTIONS, rng))
+        if day % 7 == 6:
+            events.append(survey_event(f"{study_id}-weekly", timestamp + 1000, WEEKLY_QUESTIONS, rng))
+        if rng.random() < 0.3:
+            events.append({'activity': f"{study_id}-journal", 'timestamp': timestamp + 2000, 'duration': 0, 'temporal_slices': [], 'static_data': {
+                'text': ' '.join(rng.choice(['today', 'was', 'a', 'good', 'long', 'day', 'of', 'classes']) for _ in range(rng.randrange(5, 60))),
+                'sentiment': rng.choice(['good', 'bad']),
+            }})
+    sensors = [
+        {'sensor': 'lamp.analytics', 'timestamp': start + int(i * (now - start) / max(analytics, 1)), 'data': {'page': 'feed'}}
+        for i in range(analytics)
+    ]
+    if len(sensors) > 0:
+        sensors[-1]['data'] = {'device_type': rng.choice(['iOS', 'Android']), 'device_token': f"token-{rng.randrange(10 ** 9)}", 'user_agent': 'fake'}
+    return sorted(events, key=lambda x: -x['timestamp']), sorted(sensors, key=lambda x: -x['timestamp'])
+
+# Replace all data with `studies` studies of `participants` Participants each, with `days` days of history.
+def generate(studies=2, participants=50, days=28, analytics=20, gift_codes=10000, seed=0):
+    rng, now = random.Random(seed), int(time.time() * 1000)
+    with DATA_LOCK:
+        for key in DATA:
+            DATA[key].clear()
+        DATA['tags'][(RESEARCHER_ID, 'org.digitalpsych.college_study.registered_users')] = []
+        DATA['tags'][(RESEARCHER_ID, 'org.digitalpsych.college_study.gift_codes')] = {
+            '$15': [f"GC15-{i:06d}" for i in range(gift_codes)],
+            '$20': [f"GC20-{i:06d}" for i in range(gift_codes)],
+        }
+        for s in range(studies):
+            study_id = f"study-{s}"
+            DATA['studies'].append({'id': study_id, 'name': f"Study {s}"})
+            DATA['activities'][study_id] = [
+                survey(f"{study_id}-daily", 'Daily Survey', DAILY_QUESTIONS),
+                survey(f"{study_id}-weekly", 'Weekly Survey', WEEKLY_QUESTIONS),
+                {'id': f"{study_id}-journal", 'name': 'Journal', 'spec': 'lamp.journal', 'settings': {}},
+                {'id': f"{study_id}-breathe", 'name': 'Breathe', 'spec': 'lamp.breathe', 'settings': {}},
+            ]
+            DATA['tags'][(f"{study_id}-daily", 'cortex.question_categories')] = {
+                text: {'category': ['mood', 'anxiety', 'sleep'][i % 3], 'reverse': i < 2} for i, text in enumerate(DAILY_QUESTIONS)
+            }
+            for p in range(participants):
+                participant_id = f"U{s:02d}{p:07d}"
+                email = f"{participant_id.lower()}@fake.edu"
+                DATA['participants'][participant_id] = study_id
+                DATA['credentials'][participant_id] = email
+                DATA['tags'][(RESEARCHER_ID, 'org.digitalpsych.college_study.registered_users')].append(email)
+                DATA['activity_events'][participant_id], DATA['sensor_events'][participant_id] = participant_history(study_id, days, analytics, rng, now)
+
+# Append `days` more days of history to every Participant (as if time passed), i.e. to measure incremental passes.
+def advance(days=1, seed=1):
+    rng = random.Random(seed)
+    with DATA_LOCK:
+        for participant_id, study_id in DATA['participants'].items():
+            latest = DATA['activity_events'][participant_id][0]['timestamp'] if len(DATA['activity_events'][participant_id]) > 0 else int(time.time() * 1000)
+            events, _ = participant_history(study_id, days, 0, rng, latest + days * MILLISECONDS_PER_DAY)
+            DATA['activity_events'][participant_id] = events + DATA['activity_events'][participant_id]
+
+def reset_calls():
+    with CALLS_LOCK:
+        calls = dict(CALLS)
+        CALLS.clear()
+    return calls
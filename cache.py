@@ -0,0 +1,56 @@
+import time
+import threading
+from collections import OrderedDict
+from metrics import METADATA_CACHE_REQUESTS, METADATA_CACHE_EVICTIONS
+
+# Helper class for a process-wide cache of LAMP metadata that rarely changes (i.e. the researcher's studies, their
+# activities and the question categories of each survey). Keys are (kind, id) tuples. Entries expire after `ttl`
+# seconds, and once there are more than `max_entries` the least recently used ones are evicted. Hits and misses are
+# counted per kind (see metrics.py) and in stats(). Cached values are shared between threads, so treat them as
+# read-only.
+# NOTE: A missing entry is loaded outside the lock, so concurrent misses of the same key may each load it once.
+class MetadataCache:
+    def __init__(self, ttl=10 * 60, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # The cached value for the key, or the result of load() (which is then cached, unless it raised).
+    def get(self, key, load):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                METADATA_CACHE_REQUESTS.labels(key[0], 'hit').inc()
+                return entry[1]
+            self.misses += 1
+        METADATA_CACHE_REQUESTS.labels(key[0], 'miss').inc()
+
+        value = load()
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                evicted, _ = self.entries.popitem(last=False)
+                METADATA_CACHE_EVICTIONS.labels(evicted[0]).inc()
+        return value
+
+    # Drop a single entry, every entry of a kind, or (without arguments) everything.
+    def invalidate(self, kind=None, id=None):
+        with self.lock:
+            if kind is None:
+                self.entries.clear()
+            elif id is not None:
+                self.entries.pop((kind, id), None)
+            else:
+                for key in [key for key in self.entries if key[0] == kind]:
+                    del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
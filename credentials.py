@@ -0,0 +1,116 @@
+import hmac
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import LAMP
+
+log = logging.getLogger(__name__)
+
+# Helper class that caches each Participant's login (the access key of their Credential, i.e. their email address)
+# in the event store, so that the web server and the automations worker share it. Entries are filled in by
+# registration, prefetched in bulk by the worker for every Participant it owns, and expire after `ttl` seconds minus up
+# to `jitter` of it (a fixed fraction per Participant), so entries cached together do not all expire together; a
+# missing or expired entry falls back to LAMP.Credential.list.
+class Credentials:
+    SCHEMA = """CREATE TABLE IF NOT EXISTS credentials (
+        participant TEXT PRIMARY KEY,
+        access_key TEXT NOT NULL,
+        cached_at INTEGER NOT NULL
+    )"""
+
+    # A cached entry that does not match a login is only checked against the platform again after `recheck` seconds,
+    # so a credential changed on the platform is picked up without letting every failed login cost an API call.
+    def __init__(self, store, ttl=24 * 60 * 60, recheck=60, jitter=0.25):
+        self.store = store
+        self.ttl = ttl
+        self.jitter = jitter
+        self.recheck = recheck
+        self.lock = threading.Lock()
+        self.prefetching = None
+        with self.store.connection() as db:
+            db.execute(self.SCHEMA)
+
+    def put(self, participant, access_key):
+        with self.store.connection() as db:
+            db.execute('INSERT OR REPLACE INTO credentials (participant, access_key, cached_at) VALUES (?, ?, ?)', (participant, access_key, int(time.time() * 1000)))
+
+    # Whether an entry cached at `cached_at` (in ms) is still fresh.
+    def fresh(self, participant, cached_at, now=None):
+        now = now if now is not None else time.time() * 1000
+        spread = int.from_bytes(hashlib.sha1(participant.encode()).digest()[:4], 'big') / 2 ** 32
+        return now - cached_at < self.ttl * 1000 * (1 - self.jitter * spread)
+
+    def cached(self, participant):
+        row = self.store.connection().execute('SELECT access_key, cached_at FROM credentials WHERE participant = ?', (participant,)).fetchone()
+        if row is None or not self.fresh(participant, row[1]):
+            return None
+        return row
+
+    # The Participant's access key (from the cache unless it is missing or expired), or None if they have none.
+    def access_key(self, participant, refresh=False):
+        row = self.cached(participant) if not refresh else None
+        if row is not None:
+            return row[0]
+        credentials = LAMP.Credential.list(participant)['data']
+        if len(credentials) == 0:
+            return None
+        self.put(participant, credentials[0]['access_key'])
+        return credentials[0]['access_key']
+
+    # Check a login in constant time. Returns False for unknown Participants (and on any API error).
+    def verify(self, participant, access_key):
+        try:
+            row = self.cached(participant)
+            if row is not None and hmac.compare_digest(row[0].encode(), access_key.encode()):
+                return True
+            if row is not None and time.time() * 1000 - row[1] < self.recheck * 1000:
+                return False
+            expected = self.access_key(participant, refresh=True)
+        except LAMP.ApiException as e:
+            log.warning(f"Could not look up the Credential of Participant {participant} (HTTP {e.status}).")
+            return False
+        except:
+            log.exception(f"Could not look up the Credential of Participant {participant}.")
+            return False
+        return expected is not None and hmac.compare_digest(expected.encode(), access_key.encode())
+
+    # Fetch the Credentials of the Participants whose entries are missing or expired; returns how many were fetched.
+    def prefetch(self, participants, threads=4):
+        now = time.time() * 1000
+        fresh = {participant for (participant, cached_at) in self.store.connection().execute('SELECT participant, cached_at FROM credentials') if self.fresh(participant, cached_at, now)}
+        missing = [participant for participant in participants if participant not in fresh]
+        def fetch(participant):
+            try:
+                if self.cached(participant) is not None:
+                    return False
+                return self.access_key(participant, refresh=True) is not None
+            except:
+                log.exception(f"Could not prefetch the Credential of Participant {participant}.")
+                return False
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            fetched = sum(executor.map(fetch, missing))
+        if len(missing) > 0:
+            log.info(f"Prefetched {fetched} of {len(missing)} missing or expired Participant Credentials.")
+        return fetched
+
+    # Run prefetch() in a background thread (unless the previous one is still running) so that callers need not wait
+    # for a cold cache to fill; entries not prefetched yet are fetched on demand by access_key(). Returns the thread.
+    def prefetch_in_background(self, participants, threads=4):
+        with self.lock:
+            if self.prefetching is None or not self.prefetching.is_alive():
+                self.prefetching = threading.Thread(target=self.prefetch, args=(list(participants), threads), name='credential-prefetch', daemon=True)
+                self.prefetching.start()
+            return self.prefetching
+
+    # Forget the Participants that are no longer enrolled (except those cached after `before`, i.e. who registered since
+    # the list of enrolled Participants was loaded).
+    def compact(self, enrolled, before):
+        enrolled = set(enrolled)
+        if len(enrolled) == 0:
+            return
+        db = self.store.connection()
+        removed = [(participant,) for (participant,) in db.execute('SELECT participant FROM credentials WHERE cached_at < ?', (before,)) if participant not in enrolled]
+        with db:
+            db.executemany('DELETE FROM credentials WHERE participant = ?', removed)
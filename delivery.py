@@ -0,0 +1,169 @@
+import json
+import time
+import queue
+import random
+import logging
+import requests
+import threading
+from functools import wraps
+from requests.adapters import HTTPAdapter
+from metrics import GATEWAY_REQUEST_SECONDS, GATEWAY_REQUEST_BYTES, GATEWAY_RESPONSES, GATEWAY_PENDING
+
+log = logging.getLogger(__name__)
+
+# Helper class that delivers JSON payloads to the push gateway from background sender threads.
+# All senders share one pooled HTTP session, so callers only pay for enqueueing the payload. The queue is bounded:
+# once it is full, callers block until a sender catches up instead of buffering without limit.
+# A `transport` wraps the session's POST (i.e. to record or replay the gateway traffic, see replay.py). A payload can
+# come with a `done` callback, called from the sender thread with whether the gateway accepted it.
+class DeliveryQueue:
+    def __init__(self, url, senders=4, max_pending=1000, retries=4, backoff=1.0, timeout=30, transport=None):
+        self.url = url
+        self.senders = senders
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({'Content-Type': 'application/json'})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=senders)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.post = transport(self.session.post) if transport is not None else self.session.post
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.lock = threading.Lock()
+        self.threads = []
+
+    # Sender threads are started on first use so importing this module never spawns threads.
+    def start(self):
+        with self.lock:
+            while len(self.threads) < self.senders:
+                thread = threading.Thread(target=self.run, name=f"delivery-{len(self.threads)}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def send(self, body, description, done=None):
+        self.start()
+        self.queue.put((body, description, done))
+        GATEWAY_PENDING.inc()
+
+    def run(self):
+        while True:
+            body, description, done = self.queue.get()
+            delivered = False
+            try:
+                delivered = self.deliver(body, description)
+            except Exception:
+                log.exception(f"Unexpected error delivering {description}.")
+            try:
+                if done is not None:
+                    done(delivered)
+            except Exception:
+                log.exception(f"Unexpected error confirming {description}.")
+            finally:
+                GATEWAY_PENDING.dec()
+                self.queue.task_done()
+
+    # Retry connection errors, rate limiting and server errors with jittered exponential backoff. Returns whether the
+    # gateway accepted the payload; other client errors are not retried.
+    # Requests are labeled in the metrics by kind, i.e. the "mailto", "apns", "gcm" or "slack" prefix of the recipient.
+    def deliver(self, body, description):
+        kind = str(body.get('device_token', '')).split(':', 1)[0]
+        payload = json.dumps(body)
+        GATEWAY_REQUEST_BYTES.labels(kind).observe(len(payload))
+        for attempt in range(self.retries + 1):
+            started = time.perf_counter()
+            try:
+                response = self.post(self.url, data=payload, timeout=self.timeout)
+            except requests.RequestException as e:
+                GATEWAY_RESPONSES.labels(kind, type(e).__name__).inc()
+                response, reason = None, repr(e)
+            finally:
+                GATEWAY_REQUEST_SECONDS.labels(kind).observe(time.perf_counter() - started)
+
+            # Anything but rate limiting or a server error was accepted (or rejected for good), whatever the body says.
+            if response is not None:
+                GATEWAY_RESPONSES.labels(kind, str(response.status_code)).inc()
+                if response.status_code < 400:
+                    log.debug(f"Delivered {description}: HTTP {response.status_code} {response.text}")
+                    return True
+                if response.status_code != 429 and response.status_code < 500:
+                    log.error(f"The gateway rejected {description}: HTTP {response.status_code} {response.text}")
+                    return False
+                reason = f"HTTP {response.status_code}"
+            if attempt < self.retries:
+                delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                log.warning(f"Delivering {description} failed ({reason}); retrying in {delay:.1f}s.")
+                time.sleep(delay)
+        log.error(f"Giving up delivering {description} after {self.retries + 1} attempts ({reason}).")
+        return False
+
+    # Wait until everything queued so far has been delivered (or given up on). Returns False on timeout.
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+# Helper class that coalesces messages produced while a batch of work (i.e. a worker pass) is running.
+# Only threads running a function wrapped with collect() contribute to the digest; everyone else sends directly.
+class Digest:
+    def __init__(self, send, max_length=3000):
+        self.send = send
+        self.max_length = max_length
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.messages = None
+
+    def open(self):
+        with self.lock:
+            self.messages = []
+
+    def collect(self, function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            self.local.active = True
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.local.active = False
+        return wrapper
+
+    # Returns True if the message was buffered and False if the caller should send it now.
+    def add(self, text):
+        if not getattr(self.local, 'active', False):
+            return False
+        with self.lock:
+            if self.messages is None:
+                return False
+            self.messages.append(text)
+            return True
+
+    # Send the buffered messages (and an optional closing line) as few messages as possible.
+    def close(self, footer=None):
+        with self.lock:
+            messages, self.messages = (self.messages or []), None
+        self.deliver(messages, footer)
+
+    # Send the buffered messages so far but keep collecting (i.e. periodically while a long batch is running).
+    def flush(self):
+        with self.lock:
+            if self.messages is None:
+                return
+            messages, self.messages = self.messages, []
+        self.deliver(messages)
+
+    def deliver(self, messages, footer=None):
+        if footer is not None:
+            messages.append(footer)
+        chunk = []
+        for message in messages:
+            if len(chunk) > 0 and sum(len(x) + 1 for x in chunk) + len(message) > self.max_length:
+                self.send('\n'.join(chunk))
+                chunk = []
+            chunk.append(message)
+        if len(chunk) > 0:
+            self.send('\n'.join(chunk))
@@ -0,0 +1,63 @@
+import time
+import logging
+import threading
+import LAMP
+import ingest
+
+log = logging.getLogger(__name__)
+
+# Helper class that resolves a Participant's push device ("apns:<token>" or "gcm:<token>") from their "lamp.analytics"
+# SensorEvents. Lookups are answered from memory (or the event store after a restart) until the entry expires; after
+# that only the analytics events recorded since the previous lookup are downloaded. Participants without a device are
+# cached as well, but for a shorter time since they are likely to log into the app soon.
+class DeviceRegistry:
+    def __init__(self, store, ttl=60 * 60, negative_ttl=10 * 60, page_size=1000, page_limit=None, earliest=0):
+        self.store = store
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.page_size = page_size
+        self.page_limit = page_limit
+        self.earliest = earliest
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    # Returns the Participant's most recently registered device or None if they never registered one.
+    def lookup(self, participant):
+        with self.lock:
+            entry = self.entries.get(participant)
+        if entry is None:
+            entry = self.store.get_state(participant, 'device')
+        if entry is not None and time.time() - entry['checked_at'] < (self.ttl if entry['device'] is not None else self.negative_ttl):
+            with self.lock:
+                self.entries[participant] = entry
+            return entry['device']
+        return self.refresh(participant, entry)['device']
+
+    # Fold any analytics events newer than the cached entry's watermark into it (or scan everything since `earliest` if
+    # there is none). The analytics are streamed in DESC order, so the scan stops at the first (most recently registered)
+    # device token. A scan that finds no analytics at all still moves the watermark to when it started.
+    def refresh(self, participant, entry=None):
+        watermark = entry['watermark'] if entry is not None else None
+        device = entry['device'] if entry is not None else None
+        scanned, newest, started = 0, None, int(time.time() * 1000)
+        pages = ingest.stream(LAMP.SensorEvent.all_by_participant, participant, _from=watermark + 1 if watermark is not None else None, page_size=self.page_size, page_limit=self.page_limit, earliest=self.earliest, origin="lamp.analytics")
+        for analytics in pages:
+            scanned += len(analytics)
+            newest = max([event['timestamp'] for event in analytics] + ([newest] if newest is not None else []))
+            all_devices = [event['data'] for event in analytics if 'device_token' in event['data']]
+            if len(all_devices) > 0:
+                device = f"{'apns' if all_devices[0]['device_type'] == 'iOS' else 'gcm'}:{all_devices[0]['device_token']}"
+                break
+        watermark = max([x for x in [newest, watermark] if x is not None], default=started)
+
+        entry = {'device': device, 'watermark': watermark, 'checked_at': time.time()}
+        self.store.put_state(participant, 'device', entry)
+        with self.lock:
+            self.entries[participant] = entry
+        log.debug(f"Refreshed device registry entry for Participant {participant} with {scanned} new analytics events.")
+        return entry
+
+    def invalidate(self, participant):
+        with self.lock:
+            self.entries.pop(participant, None)
+        self.store.put_state(participant, 'device', None)
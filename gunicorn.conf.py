@@ -0,0 +1,45 @@
+import os
+
+# Production web server settings, i.e. `gunicorn main:app` (the automations worker runs separately: `python worker.py`).
+# Each web process keeps its own in-memory caches on top of the event store, which all processes share.
+bind = f"0.0.0.0:{os.getenv('PORT', '3000')}"
+workers = int(os.getenv("WEB_WORKERS", "2"))
+threads = int(os.getenv("WEB_THREADS", "4"))
+timeout = int(os.getenv("WEB_TIMEOUT", "120"))
+accesslog = "-"
+
+# Remove the metric files of processes that are gone (i.e. the web workers of an earlier run) from
+# PROMETHEUS_MULTIPROC_DIR (see metrics.py), since they would be summed too. The automations worker shares the directory
+# and may run in another container, where its PID is not visible, so the PIDs it recorded (see metrics.replace_process)
+# are kept as well.
+def on_starting(server):
+    path = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if not path:
+        return
+    os.makedirs(path, exist_ok=True)
+    recorded = set()
+    for name in os.listdir(path):
+        if name.endswith('.pid'):
+            with open(os.path.join(path, name)) as f:
+                pid = f.read().strip()
+            if pid.isdigit():
+                recorded.add(int(pid))
+    for name in os.listdir(path):
+        pid = name[:-len('.db')].rsplit('_', 1)[-1] if name.endswith('.db') else ''
+        if pid.isdigit() and int(pid) not in recorded and not running(int(pid)):
+            os.remove(os.path.join(path, name))
+
+def running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# Drop the metrics of exited workers when PROMETHEUS_MULTIPROC_DIR is used (see metrics.py).
+def child_exit(server, worker):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,40 @@
+import time
+
+MILLISECONDS_PER_DAY = 24 * 60 * 60 * 1000
+
+# Stream a Participant's events from a LAMP event endpoint (i.e. LAMP.ActivityEvent.all_by_participant), newest first
+# like the API itself, as one page (list) per time window so that only a single page is ever held in memory.
+# The window starts at a day and adapts to the Participant's event rate: it doubles while pages come back with fewer than
+# a quarter of page_size events (so empty stretches and the reach back to `_from` take few requests) and halves when
+# a page comes back larger than page_size. If the platform caps the events per request at page_limit, a full page
+# continues from its oldest event instead; that boundary event may be yielded twice, so consumers must be idempotent.
+# With `_from` (i.e. an incremental pull), the first request covers the whole range, since it is usually short.
+# Without it, the reach back stops at `earliest` (i.e. when the study started) instead of the epoch.
+def stream(endpoint, participant, _from=None, to=None, page_size=1000, page_limit=None, window=MILLISECONDS_PER_DAY, earliest=0, **kwargs):
+    lower = _from if _from is not None else earliest
+    cursor = to
+    if _from is not None:
+        window = max(window, (to if to is not None else int(time.time() * 1000)) - _from)
+    while True:
+        start = max(lower, (cursor if cursor is not None else int(time.time() * 1000)) - window)
+        query = dict(kwargs, _from=start)
+        if cursor is not None:
+            query['to'] = cursor
+        page = endpoint(participant, **query)['data']
+        if len(page) > 0:
+            yield page
+
+        # The platform truncated the page, so the rest of this window is older than its oldest event.
+        if page_limit is not None and len(page) >= page_limit:
+            oldest = min(event['timestamp'] for event in page)
+            cursor = oldest if cursor is None or oldest < cursor else oldest - 1
+            window = max(window // 2, 1)
+            continue
+
+        if start <= lower:
+            return
+        cursor = start - 1
+        if len(page) > page_size:
+            window = max(window // 2, 1)
+        elif len(page) < page_size // 4:
+            window *= 2
@@ -1,16 +1,38 @@
 import os
+import io
+import csv
 import json
+import base64
+import hashlib
 import LAMP
 import time
 import random
 import logging
-import requests
-import traceback
+import atexit
 import itertools
+import threading
+import api
+from store import EventStore
+from devices import DeviceRegistry
+from delivery import DeliveryQueue, Digest
+from scoring import SurveyTables, score_answer, weekly_score, daily_score
+from rollups import Series, ROLLUP_MODES
+from registry import RegisteredUsers, GiftCodes
+from sharding import Shard, Lease
+from scheduler import Scheduler, ACTIVE, IDLE, RETRY, FINISHED
+from tracing import Tracer
+from cache import MetadataCache
+from attachments import AttachmentWriter
+from ratelimit import RateLimiter
+from credentials import Credentials
+from replay import Recorder, Replayer
+from metrics import instrument, exposition, HTTP_REQUEST_SECONDS, WORKER_PASS_SECONDS, WORKER_PARTICIPANTS, WORKER_LAST_SUCCESS, WORKER_SCHEDULED, WORKER_WAKEUPS
 from pprint import pformat
-from threading import Timer
 from functools import reduce
-from flask import Flask, request
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from html import escape
+from datetime import datetime, timezone
+from flask import Flask, Response, request, g, has_request_context, stream_with_context
 
 VEGA_SPEC_ALL = {
     "$schema": "https://vega.github.io/schema/vega-lite/v4.json",
@@ -120,6 +142,22 @@ VEGA_SPEC_JOURNAL = {
     "data": {"values": []},
 }
 
+# Drawn behind a survey or journal graph once its points are daily/weekly rollups with a min/max range.
+VEGA_SPEC_BAND = {
+    "mark": {"type": "area", "color": "#2196f3", "opacity": 0.15},
+    "encoding": {
+        "x": {"field": "x", "type": "ordinal", "timeUnit": "utcyearmonthdate"},
+        "y": {"field": "min", "type": "quantitative"},
+        "y2": {"field": "max"},
+    },
+}
+
+VEGA_TOOLTIP_BAND = [
+    {"field": "min", "type": "nominal", "title": "MIN"},
+    {"field": "max", "type": "nominal", "title": "MAX"},
+    {"field": "n", "type": "nominal", "title": "ENTRIES"},
+]
+
 # [REQUIRED] Environment Variables
 # TODO: Remove all remaining hard-coded text/links.
 DEBUG_MODE = True if os.getenv("DEBUG_MODE") == "on" else False
@@ -134,24 +172,114 @@ LAMP_PASSWORD = os.getenv("LAMP_PASSWORD")
 RESEARCHER_ID = os.getenv("RESEARCHER_ID")
 REDCAP_REQUEST_CODE = os.getenv("REDCAP_REQUEST_CODE")
 ADMIN_REQUEST_CODE = os.getenv("ADMIN_REQUEST_CODE")
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "1"))
+WORKER_INTERVAL = int(os.getenv("WORKER_INTERVAL", "10800")) # seconds (3h); roster reload and longest check interval
+SCHEDULER_MIN_INTERVAL = int(os.getenv("SCHEDULER_MIN_INTERVAL", "300")) # seconds; check interval after new activity
+SCHEDULER_MAX_INTERVAL = int(os.getenv("SCHEDULER_MAX_INTERVAL", "86400")) # seconds; check interval of idle participants
+SCHEDULER_PROBE_INTERVAL = int(os.getenv("SCHEDULER_PROBE_INTERVAL", "60")) # seconds; study-wide new activity probe
+SLACK_DIGEST_INTERVAL = int(os.getenv("SLACK_DIGEST_INTERVAL", "300")) # seconds the worker's Slack messages are coalesced
+WORKER_SHARD = int(os.getenv("WORKER_SHARD", "0")) # this replica's shard index
+WORKER_SHARDS = int(os.getenv("WORKER_SHARDS", "1")) # number of worker replicas (set on every process)
+TRACE_REPORT_PATH = os.getenv("TRACE_REPORT_PATH", "worker_traces.json")
+TRACE_REPORT_TOP = int(os.getenv("TRACE_REPORT_TOP", "20"))
+WORKER_PROFILE_DIR = os.getenv("WORKER_PROFILE_DIR") # enables cProfile when set
+WORKER_PROFILE_SAMPLE = float(os.getenv("WORKER_PROFILE_SAMPLE", "1.0")) # fraction of Participants profiled
+EVENT_STORE_PATH = os.getenv("EVENT_STORE_PATH", "college_study.db")
+GIFT_CODES_FLUSH_EVERY = int(os.getenv("GIFT_CODES_FLUSH_EVERY", "10"))
+SPEC_MAX_AGE = int(os.getenv("SPEC_MAX_AGE", "21600")) # seconds (6h)
+SUMMARY_ROLLUP = os.getenv("SUMMARY_ROLLUP", "auto") # one of: raw, daily, weekly, lttb, auto
+SUMMARY_POINTS = int(os.getenv("SUMMARY_POINTS", "200")) # maximum points per graph (except raw)
+INGEST_PAGE_SIZE = int(os.getenv("INGEST_PAGE_SIZE", "1000")) # events per streamed page or chunk
+LAMP_PAGE_LIMIT = int(os.getenv("LAMP_PAGE_LIMIT")) if os.getenv("LAMP_PAGE_LIMIT") else None # events per API response
+STUDY_START = int(datetime.strptime(os.getenv("STUDY_START"), "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp() * 1000) if os.getenv("STUDY_START") else 0 # no events before (UTC date)
+METADATA_TTL = int(os.getenv("METADATA_TTL", "600")) # seconds studies, activities and question categories are cached
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", "4096")) # maximum cached metadata entries
+ATTACHMENT_WRITE_THREADS = int(os.getenv("ATTACHMENT_WRITE_THREADS", "4")) # concurrent Tag writes from the outbox
+LAMP_RATE = float(os.getenv("LAMP_RATE", "50")) # initial LAMP API calls per second (shared by all processes)
+LAMP_MAX_RATE = float(os.getenv("LAMP_MAX_RATE", "500")) # the rate limit never adapts above this
+LAMP_RETRIES = int(os.getenv("LAMP_RETRIES", "4")) # retries of failed background LAMP API calls
+CREDENTIAL_TTL = int(os.getenv("CREDENTIAL_TTL", "86400")) # seconds Participant logins are cached
+ADMIN_BULK_THREADS = int(os.getenv("ADMIN_BULK_THREADS", "8")) # concurrent bulk coaching notifications
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "500")) # Participants per score export response (0 = all)
+EXPORT_SYNC_AGE = int(os.getenv("EXPORT_SYNC_AGE", "3600")) # seconds; exported Participants synced longer ago are pulled
+TRAFFIC_RECORD_PATH = os.getenv("TRAFFIC_RECORD_PATH") # records all LAMP and gateway traffic to this archive when set
+TRAFFIC_REPLAY_PATH = os.getenv("TRAFFIC_REPLAY_PATH") # serves all LAMP and gateway traffic from this archive when set
+TRAFFIC_REPLAY_LATENCY = os.getenv("TRAFFIC_REPLAY_LATENCY", "original") # one of: original, zero
 # TODO: Convert to service account and "me" ID. Move all configuration into a Tag on "me".
 
 # Create an HTTP app and connect to the LAMP Platform.
 app = Flask(APP_NAME)
 LAMP.connect(LAMP_USERNAME, LAMP_PASSWORD)
+
+# Record (or replay) every LAMP API call and gateway request, i.e. to profile worker passes offline (see replay.py).
+# This is the innermost middleware, so replayed calls are still paced, retried, instrumented and traced.
+TRAFFIC = Replayer(TRAFFIC_REPLAY_PATH, TRAFFIC_REPLAY_LATENCY) if TRAFFIC_REPLAY_PATH else Recorder(TRAFFIC_RECORD_PATH) if TRAFFIC_RECORD_PATH else None
+if TRAFFIC is not None:
+    api.install(LAMP, TRAFFIC.middleware)
+    atexit.register(TRAFFIC.close)
+api.install(LAMP, instrument)
+
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger(__name__)
 
-# Helper class to create a repeating timer thread that executes a worker function.
-class RepeatTimer(Timer):
-    def run(self):
-        try:
-            self.function(*self.args, **self.kwargs)
-            while not self.finished.wait(self.interval):
-                self.function(*self.args, **self.kwargs)
-        except Exception as e:
-            print(traceback.format_exc())
-            os._exit(2)
+# Local copy of all Participants' ActivityEvents shared by the automations worker and the summary page.
+EVENT_STORE = EventStore(EVENT_STORE_PATH, page_size=INGEST_PAGE_SIZE, page_limit=LAMP_PAGE_LIMIT, earliest=STUDY_START)
+
+# Pace and retry every LAMP API call (each attempt is instrumented), giving web requests priority over the worker.
+# The rate limit is kept in the event store, so it is shared by every process (web servers and worker) on this machine.
+LIMITER = RateLimiter(LAMP_RATE, LAMP_MAX_RATE, retries=LAMP_RETRIES, interactive=has_request_context, store=EVENT_STORE)
+api.install(LAMP, LIMITER.middleware)
+
+# Cached push device lookups for Participants, backed by the event store.
+DEVICES = DeviceRegistry(EVENT_STORE, page_size=INGEST_PAGE_SIZE, page_limit=LAMP_PAGE_LIMIT, earliest=STUDY_START)
+
+# Compiled survey scoring tables reused across summary page requests.
+SURVEY_TABLES = SurveyTables()
+
+# Studies, activities and question categories, which only change when a researcher reconfigures the study.
+METADATA = MetadataCache(METADATA_TTL, METADATA_CACHE_SIZE)
+
+# Pooled background delivery of push notifications, emails and Slack messages through the gateway.
+DELIVERY = DeliveryQueue(f"https://{PUSH_GATEWAY}/push", transport=TRAFFIC.gateway if TRAFFIC is not None else None)
+atexit.register(DELIVERY.flush, 30)
+
+# The Participants this automations worker replica owns (and the gift card codes it prefers). With several replicas,
+# every process (including the web servers) takes a lease before writing the shared researcher-level Tags.
+SHARD = Shard(WORKER_SHARD, WORKER_SHARDS)
+SHARED_LEASES = SHARD.count > 1
+
+# Tag writes queued in a durable outbox and sent in the background, coalescing repeated updates of the same Tag.
+ATTACHMENTS = AttachmentWriter(EVENT_STORE, threads=ATTACHMENT_WRITE_THREADS)
+atexit.register(ATTACHMENTS.close)
+
+# Participants' logins (email addresses), so that signing in to the summary page is usually a local lookup.
+CREDENTIALS = Credentials(EVENT_STORE, CREDENTIAL_TTL)
+
+# Email addresses that already registered, written back to the registered_users Tag in batches.
+REGISTERED_USERS = RegisteredUsers(EVENT_STORE, RESEARCHER_ID, lease=Lease(RESEARCHER_ID, 'registered_users') if SHARED_LEASES else None)
+atexit.register(REGISTERED_USERS.flush)
+
+# Per-Participant traces (and optional profiles) of each automations worker pass.
+TRACER = Tracer(TRACE_REPORT_PATH, TRACE_REPORT_TOP, WORKER_PROFILE_DIR, WORKER_PROFILE_SAMPLE)
+api.install(LAMP, TRACER.instrument)
+
+# Gift card codes handed out by the automations worker from a per-pass pool, written back to the registry in batches.
+GIFT_CODES = GiftCodes(EVENT_STORE, RESEARCHER_ID, flush_every=GIFT_CODES_FLUSH_EVERY, dry_run=DEBUG_MODE, shard=SHARD, lease=Lease(RESEARCHER_ID, 'gift_codes') if SHARED_LEASES else None)
+
+if SUMMARY_ROLLUP not in ROLLUP_MODES:
+    raise ValueError(f"SUMMARY_ROLLUP must be one of {ROLLUP_MODES}.")
+
+# Bump whenever the layout of the summary spec changes so that every cached spec is rebuilt.
+SPEC_VERSION = 2
+SPEC_LAYOUT = f"{SPEC_VERSION}-{SUMMARY_ROLLUP}-{SUMMARY_POINTS}"
+
+# How many raw points a series keeps: all of them for the modes that render them, none for the rollup modes, and (for
+# the auto mode) only until there are more than can be shown.
+SUMMARY_RAW_LIMIT = {'raw': None, 'lttb': None, 'auto': SUMMARY_POINTS}.get(SUMMARY_ROLLUP, 0)
+
+# How long a summary page link stays valid, and how recently a Participant must have been synced to skip a pull.
+SUMMARY_TOKEN_TTL = 24 * 60 * 60
+SUMMARY_SYNC_AGE = 5 * 60
 
 # Helper function for an HTML response template that adds a slight theme to the page.
 html = lambda body, disable_css=False: f"""
@@ -175,7 +303,8 @@ html = lambda body, disable_css=False: f"""
 """
 
 # Helper function to send custom push notifications to devices or emails to addresses.
-def push(device, content, expiry=86400000):
+# `done` is called with whether the gateway accepted it once it was sent (right away in DEBUG_MODE, where nothing is).
+def push(device, content, expiry=86400000, done=None):
     if device.split(':', 1)[0] == 'mailto':
         push_body = {
             'api_key': PUSH_API_KEY,
@@ -189,11 +318,9 @@ def push(device, content, expiry=86400000):
         }
         if DEBUG_MODE:
             log.debug(pformat(push_body))
+            done and done(True)
         else:
-            response = requests.post(f"https://{PUSH_GATEWAY}/push", headers={
-                'Content-Type': 'application/json'
-            }, json=push_body).json()
-            log.debug(pformat(response))
+            DELIVERY.send(push_body, f"email to {device}", done)
         log.info(f"Sent email to {device} with content {content}.")
     else: 
         push_body = {
@@ -215,14 +342,16 @@ def push(device, content, expiry=86400000):
         }
         if DEBUG_MODE:
             log.debug(pformat(push_body))
+            done and done(True)
         else:
-            response = requests.post(f"https://{PUSH_GATEWAY}/push", headers={
-                'Content-Type': 'application/json'
-            }, json=push_body).json()
+            DELIVERY.send(push_body, f"push notification to {device}", done)
         log.info(f"Sent push notification to {device} with content {content}.")
 
 # Requires Slack to be set up; alternative to checking script logs.
-def slack(text):
+# Messages sent by the automations worker are coalesced into a digest per pass, except for [URGENT] ones.
+def slack(text, coalesce=True):
+    if coalesce and not text.startswith('[URGENT]') and SLACK_DIGEST.add(text):
+        return
     push_body = {
         'api_key': PUSH_API_KEY,
         'device_token': f"slack:{PUSH_SLACK_HOOK}",
@@ -233,119 +362,135 @@ def slack(text):
     if DEBUG_MODE:
         log.debug(pformat(push_body))
     else:
-        response = requests.post(f"https://{PUSH_GATEWAY}/push", headers={
-            'Content-Type': 'application/json'
-        }, json=push_body).json()
-        log.info(f"Slack message response: {response}.")
-# TODO
-def patient_graphs(participant):
+        DELIVERY.send(push_body, "Slack message")
 
-    # Get survey events for participant.
-    def survey_results(activities, events):
-        survey_dict = {x['id']: x for x in activities if x["spec"] == "lamp.survey"}
-        participant_surveys = {}  # maps survey_type to occurence of scores
-        qc_dicts = {}  # maps activity ids to question category dicts
-        for event in events:
-            # Check if it's a survey event
-            if event["activity"] not in survey_dict or len(event["temporal_slices"]) == 0:
+SLACK_DIGEST = Digest(lambda text: slack(text, coalesce=False))
+
+# Helper functions to look up (cached) study configuration; see METADATA.
+def cached_studies():
+    return METADATA.get(('studies', RESEARCHER_ID), lambda: LAMP.Study.all_by_researcher(RESEARCHER_ID)['data'])
+
+def cached_activities(study_id):
+    return METADATA.get(('activities', study_id), lambda: LAMP.Activity.all_by_study(study_id)['data'])
+
+def cached_participant_activities(participant_id):
+    return METADATA.get(('participant_activities', participant_id), lambda: LAMP.Activity.all_by_participant(participant_id)['data'])
+
+def cached_question_categories(activity_id):
+    def load():
+        try:
+            return LAMP.Type.get_attachment(activity_id, 'cortex.question_categories')['data']
+        except LAMP.ApiException:
+            return {}
+    return METADATA.get(('question_categories', activity_id), load)
+
+# Get survey events for participant.
+# NOTE: Pass the same `tables` to every call when scoring a Participant's events chunk by chunk.
+def survey_results(activities, events, tables=None):
+    survey_dict = {x['id']: x for x in activities if x["spec"] == "lamp.survey"}
+    participant_surveys = {}  # maps survey_type to occurence of scores
+    tables = tables if tables is not None else {}  # maps activity ids to compiled scoring tables
+    for event in events:
+        # Check if it's a survey event
+        if event["activity"] not in survey_dict or len(event["temporal_slices"]) == 0:
+            continue
+        # Find the (cached) question categories from attachments and the scoring table compiled with them.
+        if event['activity'] not in tables:
+            question_cats = cached_question_categories(event['activity'])
+            tables[event['activity']] = SURVEY_TABLES.get(survey_dict[event['activity']], question_cats)
+
+        table = tables[event['activity']]
+        survey_result = {}  # maps question domains to scores
+        for temporal_slice in event["temporal_slices"]:  # individual questions in a survey
+            # match question info to question
+            question = table.get(temporal_slice["item"])
+            if question is None:
                 continue
-            # Find the question categories from attachments
-            if event['activity'] in qc_dicts:
-                question_cats = qc_dicts[event['activity']]
-            else:
-                try:
-                    question_cats = LAMP.Type.get_attachment(event['activity'],
-                                                             'cortex.question_categories')['data']
-                    qc_dicts[event['activity']] = question_cats
-                except LAMP.ApiException:
-                    question_cats = {}
-                    qc_dicts[event['activity']] = {}
-
-            survey = survey_dict[event['activity']]
-            survey_result = {}  # maps question domains to scores
-            for temporal_slice in event["temporal_slices"]:  # individual questions in a survey
-                found = False
-                # match question info to question
-                for question_info in survey["settings"]:
-                    if question_info["text"] == temporal_slice["item"]:
-                        found = True
-                        break
-                if not found:
-                    continue
-                # score based on question type:
-                score = None
-                event_value = temporal_slice.get("value")  # safely get 'value' incase missing keys
-                if question_info["type"] == "likert":
-                    try:
-                        score = float(event_value)
-                    except Exception:
-                        continue
-                elif question_info["type"] == "boolean" and event_value is not None:
-                    if event_value.lower() == "no":
-                        score = 0.0  # no is healthy in standard scoring
-                    elif event_value.lower() == "yes":
-                        score = 3.0  # yes is healthy in reverse scoring
-                elif (question_info["type"] in ["list", "slider", "rating"] and event_value is not None):
-                    for option_index in range(len(question_info["options"])):
-                        if event_value == question_info["options"][option_index]:
-                            score = option_index * 3 / (len(question_info["options"]) - 1)
-                if score is None:
-                    continue  # skip text, multi-select, missing options
-                # reverse score the specified questions
-                if temporal_slice["item"] in question_cats:
-                    if question_cats[temporal_slice["item"]]['reverse']:
-                        score = 3-score
-                    # add event to a category from question cats
-                    category = question_cats[temporal_slice["item"]]['category']
-                    category += f" ({survey['name']})"
-                else:
-                    category = f"_unmatched ({survey['name']})"  # default question cat
-                if category not in survey_result:
-                    survey_result[category] = []
-                survey_result[category].append(score)
-            # add mean to each cat to master dictionary
-            for category in survey_result:
-                survey_result[category] = sum(survey_result[category]) / len(survey_result[category])
-                if category not in participant_surveys:
-                    participant_surveys[category] = []
-                participant_surveys[category].append({"x": event["timestamp"], "y": survey_result[category]})
-        # sort surveys by timestamp
-        for category in participant_surveys:
-            participant_surveys[category] = sorted(participant_surveys[category], key=lambda x: x["x"])
-        return participant_surveys
-
-    # Get journal for participant
-    def journal_results(activities, events):
-        journal = [x['id'] for x in activities if x["spec"] == "lamp.journal"]
-        entries = [x for x in events if x['activity'] in journal]
-        return  [{
-            "x": entry["timestamp"],
-            "y": 1 if entry["static_data"].get("sentiment") == "good" else 0,
-            "t": entry["static_data"]["text"],
-        } for entry in entries]
+            # score based on question type:
+            score = score_answer(question, temporal_slice.get("value"))  # safely get 'value' incase missing keys
+            if score is None:
+                continue  # skip text, multi-select, missing options
+            # reverse score the specified questions
+            if question.reverse:
+                score = 3-score
+            # add event to a category from question cats
+            if question.category not in survey_result:
+                survey_result[question.category] = []
+            survey_result[question.category].append(score)
+        # add mean to each cat to master dictionary
+        for category in survey_result:
+            survey_result[category] = sum(survey_result[category]) / len(survey_result[category])
+            if category not in participant_surveys:
+                participant_surveys[category] = []
+            participant_surveys[category].append({"x": event["timestamp"], "y": survey_result[category]})
+    # sort surveys by timestamp
+    for category in participant_surveys:
+        participant_surveys[category] = sorted(participant_surveys[category], key=lambda x: x["x"])
+    return participant_surveys
+
+# Get journal for participant
+def journal_results(activities, events):
+    journal = [x['id'] for x in activities if x["spec"] == "lamp.journal"]
+    entries = [x for x in events if x['activity'] in journal]
+    return  [{
+        "x": entry["timestamp"],
+        "y": 1 if entry["static_data"].get("sentiment") == "good" else 0,
+        "t": entry["static_data"]["text"],
+    } for entry in entries]
+
+# Fold the Participant's events stored since the series were last updated into their survey and journal series;
+# without (or with outdated) state, every stored event is scored again. Events are read and scored one chunk at a
+# time, so only the series (and never the whole history) are held in memory.
+def summary_series(participant, activities, state=None):
+    if state is None or state.get('version') != SPEC_LAYOUT:
+        state = {'version': SPEC_LAYOUT, 'sequence': 0, 'surveys': {}, 'journal': None}
+    sequence = EVENT_STORE.sequence(participant)
+
+    surveys = {category: Series(series, SUMMARY_RAW_LIMIT) for category, series in state['surveys'].items()}
+    journal = Series(state['journal'], SUMMARY_RAW_LIMIT)
+    tables = {}
+    for events in EVENT_STORE.chunks(participant, state['sequence'], sequence):
+        for category, points in survey_results(activities, events, tables).items():
+            if category not in surveys:
+                surveys[category] = Series(limit=SUMMARY_RAW_LIMIT)
+            surveys[category].extend([[point["x"], point["y"]] for point in points])
+        journal.extend([[entry["x"], entry["y"], entry["t"]] for entry in journal_results(activities, events)])
+
+    return {
+        'version': SPEC_LAYOUT,
+        'sequence': sequence,
+        'surveys': {category: series.state() for category, series in surveys.items()},
+        'journal': journal.state(),
+    }
+
+# Layer a min/max band behind the graph when its points are rollups.
+def graph_spec(template, title, values):
+    graph = template.copy()
+    graph["title"] = title
+    graph["data"] = {"values": values}
+    if not any("min" in x for x in values):
+        return graph
+    line = {"mark": graph.pop("mark"), "encoding": graph.pop("encoding").copy()}
+    line["encoding"]["tooltip"] = line["encoding"]["tooltip"] + VEGA_TOOLTIP_BAND
+    graph["layer"] = [VEGA_SPEC_BAND, line]
+    return graph
+
+# TODO
+def patient_graphs(participant, series):
 
     # Start with a clone of the Vega Spec.
     spec = VEGA_SPEC_ALL.copy()
     spec["title"] = participant
     spec["vconcat"] = []
 
-    activities = LAMP.Activity.all_by_participant(participant)["data"]
-    events = LAMP.ActivityEvent.all_by_participant(participant)["data"]
-
     # Add all surveys as individual graphs.
-    results = survey_results(activities, events)
-
-    for survey in results:
-        graph = VEGA_SPEC_SURVEY.copy()
-        graph["title"] = survey
-        graph["data"] = {"values": results[survey]}
-        spec["vconcat"].append(graph.copy())
+    for survey in series['surveys']:
+        values = Series(series['surveys'][survey]).render(SUMMARY_ROLLUP, SUMMARY_POINTS)
+        spec["vconcat"].append(graph_spec(VEGA_SPEC_SURVEY, survey, values))
 
     # Add the single Journal graph.
-    journal_graph = VEGA_SPEC_JOURNAL.copy()
-    journal_graph["title"] = "Journal Entries"
-    journal_graph["data"] = {"values": journal_results(activities, events)}
-    spec["vconcat"].append(journal_graph.copy())
+    values = Series(series['journal']).render(SUMMARY_ROLLUP, SUMMARY_POINTS)
+    spec["vconcat"].append(graph_spec(VEGA_SPEC_JOURNAL, "Journal Entries", values))
 
     # Grab any dynamic visualizations that were uploaded.
     # TODO: This could be dynamically looped by listing attachments instead of hardcoding.
@@ -359,8 +504,25 @@ def patient_graphs(participant):
 #         spec3 = LAMP.Type.get_attachment(participant, "lamp.dashboard.experimental.sensor_data_quality.3hr")["data"]
 #     except LAMP.ApiException:
 #         spec3 = []
+    return spec
+
+# Return the Participant's (JSON-ified) Vega Spec from the cache, updating it if events were stored since it was built.
+# Only the new events are folded into the series, but once the spec is older than SPEC_MAX_AGE the series are
+# rebuilt from scratch (which picks up Activity or question category changes).
+def materialize_spec(participant, activities=None):
+    cached = EVENT_STORE.get_spec(participant)
+    fresh = cached is not None and time.time() * 1000 - cached['built_at'] < SPEC_MAX_AGE * 1000
+    if fresh and cached['version'] == f"{SPEC_LAYOUT}.{EVENT_STORE.sequence(participant)}":
+        return cached
+    if activities is None:
+        activities = cached_participant_activities(participant)
+    series = summary_series(participant, activities, EVENT_STORE.get_state(participant, 'summary') if fresh else None)
+    EVENT_STORE.put_state(participant, 'summary', series)
+    return EVENT_STORE.put_spec(participant, f"{SPEC_LAYOUT}.{series['sequence']}", json.dumps(patient_graphs(participant, series)))
 
-    # Return JSON-ified Vega Spec.
+# The summary page only embeds a link to the Participant's spec, so reloads can be answered with a 304 Not Modified.
+def summary_page(participant):
+    token = EVENT_STORE.issue_token(participant, SUMMARY_TOKEN_TTL)
     return f"""
         <div id="vis"></div>
         <div id="vis2"></div>
@@ -369,13 +531,143 @@ def patient_graphs(participant):
         <script src="https://cdn.jsdelivr.net/npm/vega-lite@latest"></script>
         <script src="https://cdn.jsdelivr.net/npm/vega-embed@latest"></script>
         <script type="text/javascript">
-            vegaEmbed('#vis', {json.dumps(spec)}, {{ renderer: 'svg' }});
+            vegaEmbed('#vis', '/summary/spec?token={token}', {{ renderer: 'svg' }});
         </script>
     """
+# Send the generic coaching notification to a Participant. Returns False if they have no registered device.
+def coaching_notification(participant_id):
+    device = DEVICES.lookup(participant_id)
+    if device is None:
+        log.warning(f"No applicable devices registered for Participant {participant_id}.")
+        return False
+    push(device, f"You have a new coaching message in mindLAMP.")
+    log.info(f"Completed notification process for {participant_id}.")
+    return True
+
+# The Participant IDs to notify from a list (or CSV) of Participant and Study IDs, where a Study stands for all of its
+# Participants. Duplicates are dropped, keeping the first occurrence.
+def bulk_recipients(text):
+    studies = {study['id'] for study in cached_studies()}
+    recipients = []
+    for entry in text.replace(',', ' ').replace(';', ' ').split():
+        if entry in studies:
+            recipients.extend(participant['id'] for participant in LAMP.Participant.all_by_study(entry)['data'])
+        else:
+            recipients.append(entry)
+    return list(dict.fromkeys(recipients))
+
+# Send the coaching notification to many Participants at once (ADMIN_BULK_THREADS at a time), yielding an HTML line
+# per Participant as soon as they are done and a summary at the end, which is also the only Slack message sent.
+def bulk_notifications(recipients):
+    started, sent, no_device, failed = time.time(), 0, [], []
+    yield f"<p>Sending the coaching notification to {len(recipients)} Participants...</p>\n"
+    with ThreadPoolExecutor(max_workers=ADMIN_BULK_THREADS) as executor:
+        pending = {executor.submit(coaching_notification, participant_id): participant_id for participant_id in recipients}
+        for i, future in enumerate(as_completed(pending)):
+            participant_id = pending[future]
+            try:
+                if future.result():
+                    sent += 1
+                    status = "sent"
+                else:
+                    no_device.append(participant_id)
+                    status = "no registered device"
+            except:
+                log.exception(f"Sending notification failed for {participant_id}.")
+                failed.append(participant_id)
+                status = "failed"
+            yield f"<div>[{i + 1}/{len(recipients)}] {escape(participant_id)}: {status}</div>\n"
+    summary = f"Sent coaching notification to {sent} of {len(recipients)} Participants upon administrator request in {time.time() - started:.1f}s."
+    if len(no_device) > 0:
+        summary += f" No registered device: {', '.join(no_device)}."
+    if len(failed) > 0:
+        summary += f" Failed: {', '.join(failed)}."
+    slack(summary)
+    yield f"<p>{escape(summary)}</p>\n"
+
+# The columns of the score export. Each row is one score: a Daily or Weekly Survey score (as used by the automations),
+# the mean of a survey question category (as graphed on the summary page) or a journal entry's sentiment (1 = good).
+# A Participant whose events could not be pulled gets an extra 'unsynced' row (without timestamp and value), so the
+# rows exported for them may be incomplete.
+EXPORT_COLUMNS = ['study', 'participant', 'timestamp', 'kind', 'name', 'value']
+
+# Export cursors are the opaque (study, participant) key of the last Participant of the previous response.
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+def decode_cursor(cursor):
+    return tuple(json.loads(base64.urlsafe_b64decode(cursor.encode())))
+
+# The (study, participant) keys of every Participant of the given studies in a stable order, starting after `cursor`.
+def export_roster(studies, cursor=None):
+    keys = []
+    for study in studies:
+        keys.extend((study['id'], participant['id']) for participant in LAMP.Participant.all_by_study(study['id'])['data'])
+    return [key for key in sorted(keys) if cursor is None or key > cursor]
+
+# Score a Participant's stored events (timestamped within _from..to) one chunk at a time, yielding the export rows.
+def export_rows(study_id, participant_id, activities, _from=None, to=None):
+    daily_survey = next((x for x in activities if x['name'] == 'Daily Survey'), None)
+    weekly_survey = next((x for x in activities if x['name'] == 'Weekly Survey'), None)
+    tables = {}
+    for events in EVENT_STORE.chunks(participant_id, _from=_from, to=to):
+        for event in events:
+            if daily_survey is not None and event['activity'] == daily_survey['id']:
+                yield [study_id, participant_id, event['timestamp'], 'daily', daily_survey['name'], daily_score(event)]
+            elif weekly_survey is not None and event['activity'] == weekly_survey['id']:
+                yield [study_id, participant_id, event['timestamp'], 'weekly', weekly_survey['name'], weekly_score(event)]
+        for category, points in survey_results(activities, events, tables).items():
+            for point in points:
+                yield [study_id, participant_id, point['x'], 'category', category, point['y']]
+        for entry in journal_results(activities, events):
+            yield [study_id, participant_id, entry['x'], 'journal', 'Journal Entries', entry['y']]
+
+# Stream the export of the given Participants as NDJSON or CSV, a Participant's rows at a time. Each Participant's
+# events are pulled into the event store first, unless they were synced within EXPORT_SYNC_AGE (i.e. by the worker).
+def export_scores(keys, output, _from=None, to=None):
+    if output == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        yield buffer.getvalue()
+    for study_id, participant_id in keys:
+        rows = export_rows(study_id, participant_id, cached_activities(study_id), _from, to)
+        try:
+            EVENT_STORE.sync(participant_id, max_age=EXPORT_SYNC_AGE)
+        except:
+            log.exception(f"Could not sync Participant {participant_id} for the score export.")
+            rows = itertools.chain([[study_id, participant_id, None, 'unsynced', 'Events could not be pulled', None]], rows)
+        if output == 'csv':
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(rows)
+            yield buffer.getvalue()
+        else:
+            yield ''.join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n' for row in rows)
+
 # Temporary removed from spec:
 #             vegaEmbed('#vis2', {spec2}, {{ renderer: 'svg' }});
 #             vegaEmbed('#vis3', {spec3}, {{ renderer: 'svg' }});
 
+# The paths served by index() that are reported individually in the request metrics (anything else is "other").
+ROUTES = ['/', '/admin', '/admin/bulk', '/admin/export', '/admin/reload', '/admin/resync', '/summary', '/summary/spec', '/metrics']
+
+@app.before_request
+def start_request_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.path if request.path in ROUTES else 'other'
+    HTTP_REQUEST_SECONDS.labels(route, request.method, str(response.status_code)).observe(time.perf_counter() - g.started)
+    return response
+
+# Prometheus metrics for the LAMP API, push gateway, automations worker and HTTP requests.
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    body, content_type = exposition()
+    return Response(body, content_type=content_type)
+
 # Participant registration process driver code that handles all incoming HTTP requests.
 @app.route('/', methods=['GET', 'POST'], defaults={'path': ''})
 @app.route('/<path:path>', methods=['GET', 'POST'])
@@ -405,10 +697,9 @@ def index(path):
             log.warning('Participant email address did not end in .edu or ended in @students.edu which is invalid.')
             return html(f"<p>There was an error processing your request. Please use a valid student email address issued by your school.</p>")
         
-        # Before continuing, verify that the requester's email address has not already been registered.
+        # Before continuing, verify that the requester's email address has not already been registered (and reserve it).
         # NOTE: Not wrapped in try-catch because this Tag MUST exist prior to running this script.
-        registered_users = LAMP.Type.get_attachment(RESEARCHER_ID, 'org.digitalpsych.college_study.registered_users')['data']
-        if request_email in registered_users:
+        if not REGISTERED_USERS.claim(request_email):
             log.warning(f"Email address {request_email} was already in use; aborting registration.")
             return html(f"""<p>You've already signed up for this study.</p>
             <form action="mailto:{SUPPORT_EMAIL}"> 
@@ -416,21 +707,26 @@ def index(path):
             </form>""")
         
         # Select a random Study and create a new Participant and assign name and Credential.
+        participant_id = None
         try:
-            all_studies = LAMP.Study.all_by_researcher(RESEARCHER_ID)['data']
+            all_studies = cached_studies()
             selected_study = random.choice(all_studies)
             participant_id = LAMP.Participant.create(selected_study['id'], {})['data']['id']
             log.info(f"Created Participant ID {participant_id} under Study {selected_study['name']}.")
-            LAMP.Type.set_attachment(participant_id, 'me', 'lamp.name', request_email)
+            ATTACHMENTS.write(participant_id, 'me', 'lamp.name', request_email)
             LAMP.Credential.create(participant_id, {'origin': participant_id, 'access_key': request_email, 'secret_key': participant_id, 'description': "Generated Login"})
+            CREDENTIALS.put(participant_id, request_email)
             log.info(f"Configured Participant ID {participant_id} with a generated login credential using {request_email}.")
             slack(f"Created Participant ID {participant_id} with alias '{request_email}' under Study {selected_study['name']}.")
         except:
             log.exception("API ERROR")
+        if participant_id is None:
+            REGISTERED_USERS.release(request_email)
+            return html(f"<p>There was an error processing your request.</p>")
 
         # Notify the requester's email address of this information and mark them in the registered_users Tag.
         push(f"mailto:{request_email}", f"Welcome to mindLAMP.\nThank you for completing the enrollment survey and informed consent process. We have generated an account for you to download the mindLAMP app and get started.\nThis is your password: {participant_id}.\nPlease follow this link to download and login to the app: https://www.digitalpsych.org/college-covid You will need the password given to you in this email.\n")
-        LAMP.Type.set_attachment(RESEARCHER_ID, 'me', 'org.digitalpsych.college_study.registered_users', registered_users + [request_email])
+        REGISTERED_USERS.confirm(request_email)
         log.info(f"Completed registration process for {request_email}.")
         return html(f"<p>Further instructions have been emailed to {request_email}.</p>")
 
@@ -441,6 +737,30 @@ def index(path):
                 <label for="id">ID:</label><input type="text" id="id" name="id" required>
                 <label for="code">Admin Code:</label><input type="text" id="code" name="code" required>
                 <input type="submit" value="Continue">
+            </form>
+            <p>[Bulk Coaching Notification]</p>
+            <form action="/admin/bulk" method="post">
+                <label for="ids">Participant or Study IDs (one per line or comma-separated):</label><textarea id="ids" name="ids" rows="5" required></textarea>
+                <label for="code">Admin Code:</label><input type="text" id="code" name="code" required>
+                <input type="submit" value="Send to All">
+            </form>
+            <p>[Export Scores]</p>
+            <form action="/admin/export" method="post">
+                <label for="study">Study IDs (optional):</label><input type="text" id="study" name="study">
+                <label for="format">Format:</label><select id="format" name="format"><option value="csv">CSV</option><option value="ndjson">NDJSON</option></select>
+                <label for="code">Admin Code:</label><input type="text" id="code" name="code" required>
+                <input type="submit" value="Export">
+            </form>
+            <p>[Reload Study Configuration]</p>
+            <form action="/admin/reload" method="post">
+                <label for="code">Admin Code:</label><input type="text" id="code" name="code" required>
+                <input type="submit" value="Reload">
+            </form>
+            <p>[Resync Stored Participant Data]</p>
+            <form action="/admin/resync" method="post">
+                <label for="id">ID:</label><input type="text" id="id" name="id" required>
+                <label for="code">Admin Code:</label><input type="text" id="code" name="code" required>
+                <input type="submit" value="Resync">
             </form>""")
     
     # Display a simple form with a code and email input.
@@ -454,23 +774,110 @@ def index(path):
             return html(f"<p>There was an error processing your request.</p>")
         
         try:
-            # Determine the Participant's device push token or bail if none is configured.
-            analytics = LAMP.SensorEvent.all_by_participant(request_id, origin="lamp.analytics")['data']
-            all_devices = [event['data'] for event in analytics if 'device_token' in event['data']]
-            if len(all_devices) == 0:
-                log.warning(f"No applicable devices registered for Participant {participant['id']}.")
+            # Send the generic notification or bail if no device push token is configured.
+            if not coaching_notification(request_id):
                 return html(f"<p>This ID does not have a registered device.</p>")
-            device = f"{'apns' if all_devices[0]['device_type'] == 'iOS' else 'gcm'}:{all_devices[0]['device_token']}"
-
-            # Send the generic notification.
-            push(device, f"You have a new coaching message in mindLAMP.")
-            log.info(f"Completed notification process for {request_id}.")
             slack(f"Sent coaching notification to {request_id} upon administrator request.")
             return html(f"<p>Processed request for Participant ID {request_id}.</p>")
         except:
             log.info(f"Sending notification failed for {request_id}.")
             return html(f"<p>There was an error processing your request.</p>")
 
+    # Send the coaching notification to a list of Participants (or whole Studies), streaming the progress to the page.
+    elif request.path == '/admin/bulk' and request.method == 'POST':
+
+        # Validate the submitted Admin code and IDs.
+        request_ids = request.form.get('ids')
+        request_code = request.form.get('code')
+        if request_ids is None or request_code != ADMIN_REQUEST_CODE:
+            log.warning('Bulk notification input parameters were invalid.')
+            return html(f"<p>There was an error processing your request.</p>")
+        try:
+            recipients = bulk_recipients(request_ids)
+        except:
+            log.exception("Could not resolve the bulk notification recipients.")
+            return html(f"<p>There was an error processing your request.</p>")
+
+        # Stream the page around the progress lines so the browser shows them as they arrive.
+        header, footer = html("\0").split("\0")
+        def page():
+            yield header
+            yield from bulk_notifications(recipients)
+            yield footer
+        return Response(stream_with_context(page()), mimetype='text/html')
+
+    # Stream the study-wide scores (see EXPORT_COLUMNS) as NDJSON or CSV. Optional parameters select the studies
+    # (comma-separated IDs), a time range (`from` and `to` in ms) and the Participants per response (`limit`); when more
+    # remain, pass the X-Export-Cursor header of the response as `cursor` to continue (or to retry an interrupted one).
+    elif request.path == '/admin/export':
+
+        # Validate the Admin code (also accepted as an X-Admin-Code header, to keep it out of URLs) and the parameters.
+        if request.headers.get('X-Admin-Code', request.values.get('code')) != ADMIN_REQUEST_CODE:
+            log.warning('Score export input parameters were invalid.')
+            return Response(status=403)
+        try:
+            output = request.values.get('format', 'ndjson')
+            _from = int(request.values['from']) if request.values.get('from') else None
+            to = int(request.values['to']) if request.values.get('to') else None
+            limit = int(request.values.get('limit', EXPORT_PAGE_SIZE))
+            cursor = decode_cursor(request.values['cursor']) if request.values.get('cursor') else None
+            studies = cached_studies()
+            if request.values.get('study'):
+                selected = {x.strip() for x in request.values['study'].split(',') if x.strip() != ''}
+                studies = [x for x in studies if x['id'] in selected]
+                if len(studies) != len(selected):
+                    raise ValueError(f"Unknown study in {request.values['study']}.")
+            if output not in ['ndjson', 'csv'] or limit < 0:
+                raise ValueError(f"Invalid format {output} or limit {limit}.")
+        except:
+            log.warning('Score export input parameters were invalid.', exc_info=True)
+            return Response(status=400)
+        try:
+            keys = export_roster(studies, cursor)
+        except:
+            log.exception("Could not load the score export roster.")
+            return Response(status=500)
+
+        # The page of Participants is known up front, so the next cursor can be sent before the rows.
+        # NOTE: Not wrapped in stream_with_context, so the rows are scored (and their API calls paced) as background work.
+        page = keys[:limit] if limit > 0 else keys
+        response = Response(export_scores(page, output, _from, to), mimetype='text/csv' if output == 'csv' else 'application/x-ndjson')
+        response.headers['Content-Disposition'] = f"attachment; filename=scores.{output}"
+        if len(page) < len(keys):
+            response.headers['X-Export-Cursor'] = encode_cursor(page[-1])
+        log.info(f"Exporting the scores of {len(page)} of {len(keys)} remaining Participants as {output}.")
+        return response
+
+    # Force a full resync of the locally stored events for a single Participant.
+    elif request.path == '/admin/resync' and request.method == 'POST':
+
+        # Validate the submitted Admin code and Participant ID.
+        request_id = request.form.get('id')
+        request_code = request.form.get('code')
+        if request_id is None or request_code != ADMIN_REQUEST_CODE:
+            log.warning('Participant resync input parameters were invalid.')
+            return html(f"<p>There was an error processing your request.</p>")
+
+        try:
+            METADATA.invalidate('participant_activities', request_id)
+            count = EVENT_STORE.resync(request_id)
+            log.info(f"Completed resync process for {request_id}.")
+            return html(f"<p>Resynced {count} events for Participant ID {request_id}.</p>")
+        except:
+            log.exception(f"Resync failed for {request_id}.")
+            return html(f"<p>There was an error processing your request.</p>")
+
+    # Forget the cached study configuration (i.e. after activities or question categories were changed).
+    elif request.path == '/admin/reload' and request.method == 'POST':
+        if request.form.get('code') != ADMIN_REQUEST_CODE:
+            log.warning('Configuration reload input parameters were invalid.')
+            return html(f"<p>There was an error processing your request.</p>")
+        stats = METADATA.stats()
+        METADATA.invalidate()
+        SURVEY_TABLES.invalidate()
+        log.info(f"Reloading the study configuration (cache had {stats['entries']} entries, {stats['hits']} hits and {stats['misses']} misses).")
+        return html(f"<p>The study configuration will be reloaded on next use (other processes reload it within {METADATA_TTL}s).</p>")
+
     # Display a simple admin form with a code and Participant ID input.
     elif request.path == '/summary' and request.method == 'GET':
         return html(f"""<p>To view your overall study data, log in below.</p>
@@ -490,198 +897,467 @@ def index(path):
             log.warning('Login information was incorrect.')
             return html(f"<p>Incorrect login information.</p>")
         
-        # Retrieve the Participant's email address from their assigned Credential.
-        email_address = LAMP.Credential.list(request_id)['data'][0]['access_key']
-        if request_email != email_address:
+        # Compare the email address with the one of the Participant's assigned (and usually cached) Credential.
+        if not CREDENTIALS.verify(request_id, request_email):
             log.warning('Login information was incorrect.')
             return html(f"<p>Incorrect login information.</p>")
 
         # Grab the HTML for the patient.
         try:
-            return html(patient_graphs(request_id), True)
+            return html(summary_page(request_id), True)
         except:
             return html(f"<p>There was an error processing your request.</p>")
 
+    # Serve the (cached) Vega Spec for a logged-in Participant's summary page.
+    elif request.path == '/summary/spec' and request.method == 'GET':
+
+        # Validate the token issued to the Participant upon login.
+        participant_id = EVENT_STORE.resolve_token(request.args.get('token', ''))
+        if participant_id is None:
+            log.warning('Summary token was invalid or expired.')
+            return Response(status=403)
+
+        # Pull any new events (unless that was done very recently) and rebuild the spec only if they changed it.
+        try:
+            EVENT_STORE.sync(participant_id, max_age=SUMMARY_SYNC_AGE)
+            cached = materialize_spec(participant_id)
+        except:
+            log.exception(f"Building the summary spec failed for {participant_id}.")
+            return Response(status=500)
+        response = Response(cached['spec'], mimetype='application/json')
+
+        # The spec can change without new events (i.e. once rebuilt with a renamed Activity), so tag its content.
+        response.set_etag(hashlib.sha1(cached['spec'].encode()).hexdigest())
+        response.last_modified = cached['built_at'] / 1000
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
     # Unsupported HTTP Method, Path, or a similar 404.
     else:
         return html(f"<p>There was an error processing your request.</p>")
 
-# The Automations worker listens to changes in the study's patient data and triggers interventions.
-def automations_worker():
-    log.info('Awakening automations worker for processing...')
-    LIKERT_OPTIONS = ["0", "1", "2", "3"] # this + below = temporary patch
-    REVERSE_CODING = ["i was able to function well today", "today I could handle what came my way"]
+MILLISECONDS_PER_DAY = 24 * 60 * 60 * 1000
 
-    # Iterate all participants across all sub-groups in the study.
-    all_studies = LAMP.Study.all_by_researcher(RESEARCHER_ID)['data']
+# The number of recent Daily/Weekly survey scores kept per Participant between passes (only the latest two are used).
+ROLLING_SCORES = 4
+
+# Fold newly stored events (DESC order) into a Participant's rolling state, which looks like:
+#   {'sequence': int (the last event store sequence number processed), 'first_timestamp': int, 'last_timestamp': int,
+#    'weekly_count': int, 'weekly_first': [timestamp, score], 'weekly': [[timestamp, score], ...] (DESC order),
+#    'daily': [[timestamp, score], ...] (DESC order), 'retry': bool, 'finished': bool}
+def merge_participant_state(state, events, sequence, daily_survey, weekly_survey):
+    state = state or {'sequence': 0, 'first_timestamp': None, 'last_timestamp': None, 'weekly_count': 0, 'weekly_first': None, 'weekly': [], 'daily': [], 'retry': False, 'finished': False}
+    if len(events) == 0:
+        return state
+
+    timestamps = [event['timestamp'] for event in events]
+    first_timestamp = min(timestamps) if state['first_timestamp'] is None else min(state['first_timestamp'], *timestamps)
+    last_timestamp = max(timestamps) if state['last_timestamp'] is None else max(state['last_timestamp'], *timestamps)
+
+    new_weekly = [[event['timestamp'], weekly_score(event)] for event in events if event['activity'] == weekly_survey['id']]
+    new_daily = [[event['timestamp'], daily_score(event)] for event in events if event['activity'] == daily_survey['id']]
+    weekly_first = min([x for x in [state['weekly_first']] + new_weekly if x is not None], key=lambda x: x[0], default=None)
+
+    return {
+        'sequence': sequence,
+        'first_timestamp': first_timestamp,
+        'last_timestamp': last_timestamp,
+        'weekly_count': state['weekly_count'] + len(new_weekly),
+        'weekly_first': weekly_first,
+        'weekly': sorted(state['weekly'] + new_weekly, key=lambda x: x[0], reverse=True)[:ROLLING_SCORES],
+        'daily': sorted(state['daily'] + new_daily, key=lambda x: x[0], reverse=True)[:ROLLING_SCORES],
+        'retry': state['retry'],
+        'finished': state.get('finished', False),
+    }
+
+# Process a single Participant's data and trigger any gift card, PHQ-9 or intervention automations. Returns the outcome
+# (see scheduler.py) that decides when the Participant is checked again.
+# NOTE: Each Participant is handled entirely by one thread, so the ordering of their automations is preserved.
+def process_participant(participant, all_activities, daily_survey, weekly_survey):
+    log.info(f"Processing Participant \"{participant['id']}\".")
+
+    # Pull the events recorded since the last sync and only consider the ones this worker has not processed yet.
+    # They are scored one chunk at a time (merging is order-independent), so a long history is never loaded at once.
+    TRACER.mark('fetch_events')
+    previous = EVENT_STORE.get_state(participant['id'], 'worker')
+    EVENT_STORE.sync(participant['id'])
+    sequence = EVENT_STORE.sequence(participant['id'])
+    TRACER.mark('scoring')
+    state, new_events = merge_participant_state(previous, [], sequence, daily_survey, weekly_survey), 0
+    for data in EVENT_STORE.chunks(participant['id'], previous['sequence'] if previous is not None else 0, sequence):
+        state = merge_participant_state(state, data, sequence, daily_survey, weekly_survey)
+        new_events += len(data)
+    if new_events == 0 and not state['retry']:
+        log.info(f"No new events for Participant {participant['id']}; skipping.")
+        return FINISHED if state.get('finished') else IDLE
+    retry = False # Set when an automation could not complete and must be re-checked even without new events.
+
+    # Send a gift card if AT LEAST one "Weekly Survey" was completed today AND they did not already claim one.
+    # Weekly scores are the most recent (timestamp, sum(temporal_slices.value)) of the filtered events (DESC order.)
+    # NOTE: For this survey only question #9 (PHQ-9 suicide, slice 8:9) is considered as part of the score.
+    TRACER.mark('gift_codes')
+    weekly_count, weekly_first = state['weekly_count'], state['weekly_first']
+    if weekly_count >= 1:
+        # TODO: Catch "None" responses in the survey.
+
+        # Calculate the number of days between the latest ActivityEvent and the very first ActivityEvent recorded for this pt.
+        # NOTE: (state['weekly'][0][0] - state['first_timestamp']) yields "number of days since start AT TIME OF SURVEY".
+        #       This conditional logic behavior is completely different than the one implemented below:
+        days_since_start = (state['last_timestamp'] - state['first_timestamp']) / MILLISECONDS_PER_DAY
+
+        # Get the number of previously delivered gift card codes.
+        delivered_gift_codes = []
+        try:
+            delivered_gift_codes = ATTACHMENTS.read(participant['id'], 'org.digitalpsych.college_study.delivered_gift_codes')
+        except:
+            pass # 404 error if the Tag has never been created before.
+
+        # Confirm the payout amount if appropriate or bail.
+        payout_amount = None
+        if len(delivered_gift_codes) == 0 and weekly_count >= 1 and days_since_start >= 7:
+            payout_amount = "$15"
+        elif len(delivered_gift_codes) == 1 and weekly_count >= 2 and days_since_start >= 21:
+            payout_amount = "$15"
+        elif len(delivered_gift_codes) == 2 and weekly_count >= 2 and days_since_start >= 28:
+            payout_amount = "$20"
+        else:
+            log.info(f"No gift card codes to deliver to Participant {participant['id']} -- already delivered {len(delivered_gift_codes)}.")
+
+        # Begin the process of vending the payout amount. Also used to track whether we have sent a PHQ-9 notice.
+        if payout_amount is not None:
+            log.info(f"Participant {participant['id']} was approved for a payout of amount {payout_amount}.")
+            slack(f"Participant {participant['id']} was approved for a payout of amount {payout_amount}.")
+
+            # Retrieve the Participant's email address from their assigned (and usually cached) Credential.
+            email_address = CREDENTIALS.access_key(participant['id'])
+            
+            # Continue Gift Card processing after attending to PHQ-9 suicide Q score -> push notification.
+            TRACER.mark('phq9')
+            log.info(f"Participant {participant['id']} reported PHQ9 Q9 value of {weekly_first[1]}.")
+            if weekly_first[1] >= 3: #"Nearly every day"
+                
+                # Determine the Participant's device push token or bail if none is configured.
+                device = DEVICES.lookup(participant['id'])
+                if device is not None:
+                    push(device, f"Thank you for completing your weekly survey. Based on your responses, a member of the research team will reach out within 24 hours. Because your responses are not monitored in real time, we would like to remind you of some other resources that you can access if you are considering self-harm. The national suicide prevention line is a 24/7 toll-free service that can be accessed by dialing 1-800-273-8255. You may also reach out to the principal investigator of this study, Dr. John Torous, MD, by dialing 1-510-684-6827.")
+                    
+                    # Record success/failure to send push notification.
+                    log.info(f"Sent PHQ-9 notice to Participant {participant['id']} via push notification.")
+                    slack(f"Participant {participant['id']} reported PHQ9 Q9 value of {weekly_first[1]}; sent push notification notice.", coalesce=False)
+                else:
+                    log.warning(f"PHQ-9 notice failed: no applicable devices registered for Participant {participant['id']}.")
+                    retry = True
+                    slack(f"[URGENT] FAILED TO SEND PHQ-9 NOTICE TO Participant {participant['id']}: reported PHQ9 Q9 value of {weekly_first[1]}.")
+            
+            # Retreive an available gift card code from the study registry and deliver the email. 
+            TRACER.mark('gift_codes')
+            # NOTE: Not wrapped in try-catch because this Tag MUST exist prior to running this script.
+            participant_code = GIFT_CODES.allocate(payout_amount, participant['id'])
+            if participant_code is not None:
+
+                # Only confirm the code once the gateway accepted the email; otherwise it stays allocated, and the next
+                # pass reports it (see begin_pass).
+                def confirm(delivered, code=participant_code, participant_id=participant['id']):
+                    if delivered:
+                        GIFT_CODES.delivered(code)
+                        log.info(f"Confirmed delivery of gift card code {code} to the Participant {participant_id}.")
+                    else:
+                        log.error(f"Could not deliver gift card code {code} to the Participant {participant_id}; it remains unconfirmed.")
+
+                # We have a gift card code allocated to send to this participant.
+                push(f"mailto:{email_address}", f"Your mindLAMP Progress.\nThanks for completing your weekly activities! Here's your Amazon Gift Card Code: [{participant_code}]. Please ensure you fill out a payment form ASAP: https://www.digitalpsych.org/college-payment-forms", done=confirm)
+                log.info(f"Delivered gift card code {participant_code} to the Participant {participant['id']} via email.")
+                slack(f"Delivered gift card code {participant_code} to the Participant {participant['id']} via email at {email_address}.")
+
+                # Mark the gift card code as claimed by a participant (the allocator removes it from the study registry).
+                # NOTE: The Tag is written from the durable outbox; later checks read it back through ATTACHMENTS.
+                if DEBUG_MODE:
+                    log.debug(pformat(delivered_gift_codes + [participant_code]))
+                else:
+                    ATTACHMENTS.write(RESEARCHER_ID, participant['id'], 'org.digitalpsych.college_study.delivered_gift_codes', delivered_gift_codes + [participant_code])
+                log.info(f"Marked gift card code {participant_code} as claimed by Participant {participant['id']}.")
+            else:
+                # We have no more gift card codes left - send an alert instead.
+                push(f"mailto:{SUPPORT_EMAIL}", f"[URGENT] No gift card codes remaining!\nCould not find a gift card code for amount {payout_amount} to send to {email_address}. Please refill gift card codes.")
+                slack(f"[URGENT] No gift card codes remaining!\nCould not find a gift card code for amount {payout_amount} to send to {email_address}. Please refill gift card codes.")
+                retry = True
+
+            # Additional offboarding/exit survey procedures and update the "lamp.name" to add a FINISHED indicator.
+            if payout_amount == "$20":
+                push(f"mailto:{email_address}", f"Your mindLAMP Progress.\nThanks for completing the study. Please complete the exit survey: https://redcap.bidmc.harvard.edu/redcap/surveys/?s=PNJ94E8DX4 -- You no longer need to fill out surveys and you can delete the app at any time now! Thank you!")
+                if not DEBUG_MODE:
+                    ATTACHMENTS.write(participant['id'], 'me', 'lamp.name', f"✅ {email_address}")
+                state['finished'] = True
+                slack(f"Delivered EXIT SURVEY and gift card code to the Participant {participant['id']} via email at {email_address}.")
+    else:
+        log.info(f"No gift card codes to deliver to Participant {participant['id']}.")
+    
+    # Trigger a (RANDOM) intervention IFF [Mood.score += 3 OR Anxiety.score +=3]. (Now called "Daily Survey".)
+    # Daily scores are the most recent (timestamp, sum(temporal_slices.value)) of the filtered events (DESC order.)
+    TRACER.mark('intervention')
+    daily_scores = state['daily']
+    if len(daily_scores) >= 2 and (daily_scores[0][1] - daily_scores[1][1]) >= 3:
+
+        # Check if we already delivered an intervention for this event (and bail if we did).
+        delivered_interventions = []
+        try:
+            delivered_interventions = ATTACHMENTS.read(participant['id'], 'org.digitalpsych.college_study.delivered_interventions')
+        except:
+            pass # 404 error if the Tag has never been created before.
+        last_delivered_time = delivered_interventions[-1]['timestamp'] if len(delivered_interventions) > 0 else 0
+        if daily_scores[0][0] > last_delivered_time:
+
+            # Determine the Participant's device push token or bail if none is configured.
+            device = DEVICES.lookup(participant['id'])
+            if device is not None:
+                
+                # Determine one of three random interventions and deliver it to the Participant's Feed.
+                intervention = random.choice(['lamp.journal', 'lamp.breathe', None])
+                if intervention == 'lamp.journal':
+                    activity = [x for x in all_activities if x['spec'] == intervention]
+                    if len(activity) > 0:
+                        push(device, f"You have a new mindLAMP activity: {activity[0]['name']}")
+                        log.info(f"Delivered an intervention to Participant {participant['id']}.")
+                    else:
+                        log.error(f"No such intervention \"{intervention}\" to deliver to Participant {participant['id']}.")
+                elif intervention == 'lamp.breathe':
+                    activity = [x for x in all_activities if x['spec'] == intervention]
+                    if len(activity) > 0:
+                        push(device, f"You have a new mindLAMP activity: {activity[0]['name']}")
+                        log.info(f"Delivered an intervention to Participant {participant['id']}.")
+                    else:
+                        log.error(f"No such intervention \"{intervention}\" to deliver to Participant {participant['id']}.")
+                else:
+                    # Send a placebo message, since the semantics of sensor collection may change if we don't.
+                    push(device, None)
+                    log.info(f"Sent a placebo notification to Participant {participant['id']}.")
+
+                # Track the delivered intervention (or None) for data purposes. 
+                current = {'timestamp': daily_scores[0][0], 'delivered_on': int(time.time() * 1000), 'intervention': intervention}
+                if not DEBUG_MODE:
+                    ATTACHMENTS.write(RESEARCHER_ID, participant['id'], 'org.digitalpsych.college_study.delivered_interventions', delivered_interventions + [current])
+                log.info(f"Marked an intervention {intervention} as triggered on {current['delivered_on']} for Participant {participant['id']}.")
+                slack(f"Marked an intervention {intervention} as triggered on {current['timestamp']} for Participant {participant['id']}.")
+            else:
+                log.warning(f"Skipping; no applicable devices registered for Participant {participant['id']}.")
+                retry = True
+        else:
+            log.info(f"Skipping; already processed an earlier intervention for Participant {participant['id']}.")
+    else:
+        log.info(f"No interventions to deliver to Participant {participant['id']}.")
+
+    # Only advance the watermark once every automation for these events has been attempted.
+    TRACER.mark('save_state')
+    state['retry'] = retry
+    EVENT_STORE.put_state(participant['id'], 'worker', state)
+
+    # Pre-render the summary page now that new events arrived so the Participant's next visit is served from cache.
+    TRACER.mark('summary_spec')
+    try:
+        materialize_spec(participant['id'], all_activities)
+    except:
+        log.exception(f"Could not pre-render the summary spec for Participant {participant['id']}.")
+    return RETRY if retry else FINISHED if state.get('finished') else ACTIVE
+
+# Every study of the researcher, the IDs of all Participants enrolled in them, and the process_participant arguments
+# (participant, all_activities, daily_survey, weekly_survey) of the Participants this replica owns, by ID.
+def load_roster():
+    all_studies = cached_studies()
+    enrolled, roster = [], {}
     for study in all_studies:
-        log.info(f"Processing Study \"{study['name']}\".")
+        log.info(f"Loading Study \"{study['name']}\".")
 
         # Specifically look for the "Daily Survey" and "Weekly Survey" activities.
-        all_activities = LAMP.Activity.all_by_study(study['id'])['data']
+        all_activities = cached_activities(study['id'])
         daily_survey = [x for x in all_activities if x['name'] == 'Daily Survey'][0]
         weekly_survey = [x for x in all_activities if x['name'] == 'Weekly Survey'][0]
 
-        # Iterate across all RECENT (only the previous day) patient data.
         all_participants = LAMP.Participant.all_by_study(study['id'])['data']
         for participant in all_participants:
-            log.info(f"Processing Participant \"{participant['id']}\".")
-            data = LAMP.ActivityEvent.all_by_participant(participant['id'])['data']
-
-            # Send a gift card if AT LEAST one "Weekly Survey" was completed today AND they did not already claim one.
-            # Weekly scores are a filtered list of events in the format: (timestamp, sum(temporal_slices.value)) (DESC order.)
-            # NOTE: For this survey only question #9 (PHQ-9 suicide, slice 8:9) is considered as part of the score.
-            weekly_scores = [(
-                event['timestamp'],
-                sum(map(lambda slice: LIKERT_OPTIONS.index(slice['value']) if slice.get('value', None) in LIKERT_OPTIONS else 0, event['temporal_slices'][8:9])))
-                for event in data if event['activity'] == weekly_survey['id']
-            ]
-            if len(weekly_scores) >= 1:
-                # TODO: Catch "None" responses in the survey.
-
-                # Calculate the number of days between the latest Weekly Survey and the very first ActivityEvent recorded for this pt.
-                # NOTE: (weekly_scores[0][0] - data[-1]['timestamp']) yields "number of days since start AT TIME OF SURVEY".
-                #       This conditional logic behavior is completely different than the one implemented below:
-                days_since_start = (data[0]['timestamp'] - data[-1]['timestamp']) / (24 * 60 * 60 * 1000) # MILLISECONDS_PER_DAY
-
-                # Get the number of previously delivered gift card codes.
-                delivered_gift_codes = []
+            enrolled.append(participant['id'])
+            if SHARD.owns(participant['id']):
+                roster[participant['id']] = (participant, all_activities, daily_survey, weekly_survey)
+    return all_studies, enrolled, roster
+
+# Retry any registrations that the web server could not write back to the registered_users Tag yet, and load the gift
+# card code registry (reporting any codes that a crashed pass never delivered).
+def begin_pass():
+    try:
+        REGISTERED_USERS.flush()
+    except:
+        log.exception("Could not write back the registered users Tag.")
+    for code, amount, participant_id in GIFT_CODES.begin():
+        slack(f"[URGENT] Gift card code {code} ({amount}) was allocated to Participant {participant_id} but never confirmed as delivered; please check with them.")
+
+# The Participants of the studies with ActivityEvents timestamped since `since` (in ms), found with one query per study
+# instead of one per Participant. The platform groups the study's events by Participant: [{'id': ..., 'data': [...]}].
+# NOTE: Events uploaded late (i.e. from an offline phone) carry older timestamps and are only found by the regular checks.
+def active_participants(studies, since):
+    active = set()
+    for study in studies:
+        for group in LAMP.ActivityEvent.all_by_study(study['id'], _from=since)['data']:
+            if len(group['data']) > 0:
+                active.add(group['id'])
+    return active
+
+# The Automations worker listens to changes in the study's patient data and triggers interventions.
+# This runs a single pass over every Participant; see automations_scheduler() for the continuously running worker.
+def automations_worker():
+    log.info('Awakening automations worker for processing...')
+    started = time.time()
+    SLACK_DIGEST.open()
+    TRACER.open()
+    traced_participant = SLACK_DIGEST.collect(TRACER.collect(process_participant, lambda participant, *args: participant['id']))
+
+    # Iterate all participants across all sub-groups in the study.
+    try:
+        begin_pass()
+        _, enrolled, roster = load_roster()
+        prefetching = CREDENTIALS.prefetch_in_background(roster.keys(), max(1, WORKER_THREADS // 2))
+        with ThreadPoolExecutor(max_workers=WORKER_THREADS) as executor:
+            pending = [executor.submit(traced_participant, *work) for work in roster.values()]
+
+            # Surface the first failure (if any) to the caller once all Participants were attempted.
+            failure = None
+            for future in pending:
                 try:
-                    delivered_gift_codes = LAMP.Type.get_attachment(participant['id'], 'org.digitalpsych.college_study.delivered_gift_codes')['data']
-                except:
-                    pass # 404 error if the Tag has never been created before.
-
-                # Confirm the payout amount if appropriate or bail.
-                payout_amount = None
-                if len(delivered_gift_codes) == 0 and len(weekly_scores) >= 1 and days_since_start >= 7:
-                    payout_amount = "$15"
-                elif len(delivered_gift_codes) == 1 and len(weekly_scores) >= 2 and days_since_start >= 21:
-                    payout_amount = "$15"
-                elif len(delivered_gift_codes) == 2 and len(weekly_scores) >= 2 and days_since_start >= 28:
-                    payout_amount = "$20"
-                else:
-                    log.info(f"No gift card codes to deliver to Participant {participant['id']} -- already delivered {len(delivered_gift_codes)}.")
+                    future.result()
+                    WORKER_PARTICIPANTS.labels('ok').inc()
+                except Exception as e:
+                    WORKER_PARTICIPANTS.labels('failed').inc()
+                    failure = failure or e
+            if failure is not None:
+                raise failure
+        GIFT_CODES.end()
+        ATTACHMENTS.flush()
+        prefetching.join()
+        EVENT_STORE.compact(enrolled)
+        CREDENTIALS.compact(enrolled, int(started * 1000))
+    except:
+        WORKER_PASS_SECONDS.labels('failed').observe(time.time() - started)
+        TRACER.close('failed')
+        SLACK_DIGEST.close(f"[URGENT] Processing failed after {time.time() - started:.1f}s.")
+        raise
+    elapsed = time.time() - started
+    WORKER_PASS_SECONDS.labels('ok').observe(elapsed)
+    WORKER_LAST_SUCCESS.set_to_current_time()
+    TRACER.close()
+    log.info(f"Sleeping automations worker... (pass took {elapsed:.1f}s across {len(pending)} participants of shard {SHARD} with {WORKER_THREADS} threads.)")
+    SLACK_DIGEST.close(f"Completed processing{f' of shard {SHARD}' if SHARD.count > 1 else ''} in {elapsed:.1f}s.")
 
-                # Begin the process of vending the payout amount. Also used to track whether we have sent a PHQ-9 notice.
-                if payout_amount is not None:
-                    log.info(f"Participant {participant['id']} was approved for a payout of amount {payout_amount}.")
-                    slack(f"Participant {participant['id']} was approved for a payout of amount {payout_amount}.")
+# Run the automations worker continuously until `stopped` is set. Instead of a pass over everyone every WORKER_INTERVAL,
+# each Participant is checked whenever the scheduler says they are due: soon after any new activity, and less and less
+# often while they are idle or finished (see scheduler.Scheduler). Every SCHEDULER_PROBE_INTERVAL, one query per study
+# wakes the Participants with new ActivityEvents, so a submitted survey is acted upon within minutes; idle Participants
+# are then only checked every SCHEDULER_MAX_INTERVAL (or WORKER_INTERVAL if the platform lacks the probe). The expensive
+# work (reloading the roster and gift card code registry, writing back the registries and compacting the event store)
+# is done once per cycle of WORKER_INTERVAL, which also closes that cycle's trace report and Slack digest; the digest
+# is also sent every SLACK_DIGEST_INTERVAL in between, and PHQ-9 alerts are never held back.
+def automations_scheduler(stopped=None):
+    stopped = stopped or threading.Event()
+    schedule = Scheduler(SCHEDULER_MIN_INTERVAL, SCHEDULER_MAX_INTERVAL)
+    traced_participant = SLACK_DIGEST.collect(TRACER.collect(process_participant, lambda participant, *args: participant['id']))
+    studies, enrolled, roster, running = [], [], {}, {}
+    cycle_started, probed_at, probing, checks, failures, roster_loaded = None, None, True, 0, 0, False
+    digest_sent = time.time()
+    with ThreadPoolExecutor(max_workers=WORKER_THREADS) as executor:
+        while not stopped.is_set():
+            now = time.time()
 
-                    # Retrieve the Participant's email address from their assigned Credential.
-                    email_address = LAMP.Credential.list(participant['id'])['data'][0]['access_key']
-                    
-                    # Continue Gift Card processing after attending to PHQ-9 suicide Q score -> push notification.
-                    log.info(f"Participant {participant['id']} reported PHQ9 Q9 value of {weekly_scores[-1][1]}.")
-                    if weekly_scores[-1][1] >= 3: #"Nearly every day"
-                        
-                        # Determine the Participant's device push token or bail if none is configured.
-                        analytics = LAMP.SensorEvent.all_by_participant(participant['id'], origin="lamp.analytics")['data']
-                        all_devices = [event['data'] for event in analytics if 'device_token' in event['data']]
-                        if len(all_devices) > 0:
-                            device = f"{'apns' if all_devices[0]['device_type'] == 'iOS' else 'gcm'}:{all_devices[0]['device_token']}"
-                            push(device, f"Thank you for completing your weekly survey. Based on your responses, a member of the research team will reach out within 24 hours. Because your responses are not monitored in real time, we would like to remind you of some other resources that you can access if you are considering self-harm. The national suicide prevention line is a 24/7 toll-free service that can be accessed by dialing 1-800-273-8255. You may also reach out to the principal investigator of this study, Dr. John Torous, MD, by dialing 1-510-684-6827.")
-                            
-                            # Record success/failure to send push notification.
-                            log.info(f"Sent PHQ-9 notice to Participant {participant['id']} via push notification.")
-                            slack(f"Participant {participant['id']} reported PHQ9 Q9 value of {weekly_scores[-1][1]}; sent push notification notice.")
-                        else:
-                            log.warning(f"PHQ-9 notice failed: no applicable devices registered for Participant {participant['id']}.")
-                            slack(f"[URGENT] FAILED TO SEND PHQ-9 NOTICE TO Participant {participant['id']}: reported PHQ9 Q9 value of {weekly_scores[-1][1]}.")
-                    
-                    # Retreive an available gift card code from the study registry and deliver the email. 
-                    # NOTE: Not wrapped in try-catch because this Tag MUST exist prior to running this script.
-                    gift_codes = LAMP.Type.get_attachment(RESEARCHER_ID, 'org.digitalpsych.college_study.gift_codes')['data']
-                    if len(gift_codes[payout_amount]) > 0:
-
-                        # We have a gift card code allocated to send to this participant.
-                        participant_code = gift_codes[payout_amount].pop()
-                        push(f"mailto:{email_address}", f"Your mindLAMP Progress.\nThanks for completing your weekly activities! Here's your Amazon Gift Card Code: [{participant_code}]. Please ensure you fill out a payment form ASAP: https://www.digitalpsych.org/college-payment-forms")
-                        log.info(f"Delivered gift card code {participant_code} to the Participant {participant['id']} via email.")
-                        slack(f"Delivered gift card code {participant_code} to the Participant {participant['id']} via email at {email_address}.")
-
-                        # Mark the gift card code as claimed by a participant and remove it from the study registry.
-                        if DEBUG_MODE:
-                            log.debug(pformat(delivered_gift_codes + [participant_code]))
-                        else:
-                            LAMP.Type.set_attachment(RESEARCHER_ID, 'me', 'org.digitalpsych.college_study.gift_codes', gift_codes)
-                            LAMP.Type.set_attachment(RESEARCHER_ID, participant['id'], 'org.digitalpsych.college_study.delivered_gift_codes', delivered_gift_codes + [participant_code])
-                        log.info(f"Marked gift card code {participant_code} as claimed by Participant {participant['id']}.")
-                    else:
-                        # We have no more gift card codes left - send an alert instead.
-                        push(f"mailto:{SUPPORT_EMAIL}", f"[URGENT] No gift card codes remaining!\nCould not find a gift card code for amount {payout_amount} to send to {email_address}. Please refill gift card codes.")
-                        slack(f"[URGENT] No gift card codes remaining!\nCould not find a gift card code for amount {payout_amount} to send to {email_address}. Please refill gift card codes.")
-
-                    # Additional offboarding/exit survey procedures and update the "lamp.name" to add a FINISHED indicator.
-                    if payout_amount == "$20":
-                        push(f"mailto:{email_address}", f"Your mindLAMP Progress.\nThanks for completing the study. Please complete the exit survey: https://redcap.bidmc.harvard.edu/redcap/surveys/?s=PNJ94E8DX4 -- You no longer need to fill out surveys and you can delete the app at any time now! Thank you!")
-                        if not DEBUG_MODE:
-                            LAMP.Type.set_attachment(participant['id'], 'me', 'lamp.name', f"✅ {email_address}")
-                        slack(f"Delivered EXIT SURVEY and gift card code to the Participant {participant['id']} via email at {email_address}.")
-            else:
-                log.info(f"No gift card codes to deliver to Participant {participant['id']}.")
-            
-            # Trigger a (RANDOM) intervention IFF [Mood.score += 3 OR Anxiety.score +=3]. (Now called "Daily Survey".)
-            # Daily scores are a filtered list of events in the format: (timestamp, sum(temporal_slices.value)) (DESC order.)
-            # The questions to be reverse coded (lowercase-matched) are also flipped.
-            daily_scores = [(
-                event['timestamp'],
-                sum(map(lambda slice: (((-len(LIKERT_OPTIONS) if slice.get('item', None) in REVERSE_CODING else 0) + LIKERT_OPTIONS.index(slice['value'])) if slice.get('value', None) in LIKERT_OPTIONS else 0), event['temporal_slices'])))
-                for event in data if event['activity'] == daily_survey['id']
-            ]
-            if len(daily_scores) >= 2 and (daily_scores[0][1] - daily_scores[1][1]) >= 3:
-
-                # Check if we already delivered an intervention for this event (and bail if we did).
-                delivered_interventions = []
+            # Close the previous cycle and reload the roster.
+            if cycle_started is None or now - cycle_started >= WORKER_INTERVAL:
+                if cycle_started is not None:
+                    try:
+                        GIFT_CODES.end()
+                        ATTACHMENTS.flush()
+
+                        # Only forget Participants according to a roster that was actually loaded in this cycle.
+                        if roster_loaded:
+                            EVENT_STORE.compact(enrolled)
+                            CREDENTIALS.compact(enrolled, int(cycle_started * 1000))
+                    except:
+                        log.exception("Could not write back the gift card code registry or Tags, or compact the event store.")
+                    elapsed = now - cycle_started
+                    WORKER_PASS_SECONDS.labels('ok' if failures == 0 else 'failed').observe(elapsed)
+                    if failures == 0:
+                        WORKER_LAST_SUCCESS.set_to_current_time()
+                    TRACER.close('ok' if failures == 0 else 'failed')
+                    SLACK_DIGEST.close(f"{'[URGENT] ' if failures > 0 else ''}Completed {checks} checks ({failures} failed) of {len(roster)} participants{f' of shard {SHARD}' if SHARD.count > 1 else ''} in the last {elapsed:.0f}s.")
+                SLACK_DIGEST.open()
+                TRACER.open()
+                cycle_started, checks, failures, roster_loaded = now, 0, 0, False
                 try:
-                    delivered_interventions = LAMP.Type.get_attachment(participant['id'], 'org.digitalpsych.college_study.delivered_interventions')['data']
+                    begin_pass()
+                    studies, enrolled, roster = load_roster()
+                    roster_loaded = True
+                    schedule.retain(roster.keys(), now)
+                    CREDENTIALS.prefetch_in_background(roster.keys(), max(1, WORKER_THREADS // 2))
+                    WORKER_SCHEDULED.set(len(schedule))
                 except:
-                    pass # 404 error if the Tag has never been created before.
-                last_delivered_time = delivered_interventions[-1]['timestamp'] if len(delivered_interventions) > 0 else 0
-                if daily_scores[0][0] > last_delivered_time:
-
-                    # Determine the Participant's device push token or bail if none is configured.
-                    analytics = LAMP.SensorEvent.all_by_participant(participant['id'], origin="lamp.analytics")['data']
-                    all_devices = [event['data'] for event in analytics if 'device_token' in event['data']]
-                    if len(all_devices) > 0:
-                        device = f"{'apns' if all_devices[0]['device_type'] == 'iOS' else 'gcm'}:{all_devices[0]['device_token']}"
-                        
-                        # Determine one of three random interventions and deliver it to the Participant's Feed.
-                        intervention = random.choice(['lamp.journal', 'lamp.breathe', None])
-                        if intervention == 'lamp.journal':
-                            activity = [x for x in all_activities if x['spec'] == intervention]
-                            if len(activity) > 0:
-                                push(device, f"You have a new mindLAMP activity: {activity[0]['name']}")
-                                log.info(f"Delivered an intervention to Participant {participant['id']}.")
-                            else:
-                                log.error(f"No such intervention \"{intervention}\" to deliver to Participant {participant['id']}.")
-                        elif intervention == 'lamp.breathe':
-                            activity = [x for x in all_activities if x['spec'] == intervention]
-                            if len(activity) > 0:
-                                push(device, f"You have a new mindLAMP activity: {activity[0]['name']}")
-                                log.info(f"Delivered an intervention to Participant {participant['id']}.")
-                            else:
-                                log.error(f"No such intervention \"{intervention}\" to deliver to Participant {participant['id']}.")
-                        else:
-                            # Send a placebo message, since the semantics of sensor collection may change if we don't.
-                            push(device, None)
-                            log.info(f"Sent a placebo notification to Participant {participant['id']}.")
-
-                        # Track the delivered intervention (or None) for data purposes. 
-                        current = {'timestamp': daily_scores[0][0], 'delivered_on': int(time.time() * 1000), 'intervention': intervention}
-                        if not DEBUG_MODE:
-                            LAMP.Type.set_attachment(RESEARCHER_ID, participant['id'], 'org.digitalpsych.college_study.delivered_interventions', delivered_interventions + [current])
-                        log.info(f"Marked an intervention {intervention} as triggered on {current['delivered_on']} for Participant {participant['id']}.")
-                        slack(f"Marked an intervention {intervention} as triggered on {current['timestamp']} for Participant {participant['id']}.")
+                    log.exception("Could not reload the roster; keeping the previous one.")
+                    slack("[URGENT] Could not reload the study roster; retrying shortly.")
+                    cycle_started = now - WORKER_INTERVAL + SCHEDULER_MIN_INTERVAL
+
+            # Send the Slack messages coalesced so far, so the research team hears about them within minutes.
+            if now - digest_sent >= SLACK_DIGEST_INTERVAL:
+                SLACK_DIGEST.flush()
+                digest_sent = now
+
+            # Wake the Participants with new activity since the last probe (with some overlap for clock skew).
+            if probing and (probed_at is None or now - probed_at >= SCHEDULER_PROBE_INTERVAL):
+                try:
+                    since = int((probed_at if probed_at is not None else now - SCHEDULER_PROBE_INTERVAL) * 1000) - 60 * 1000
+                    active = active_participants(studies, since)
+                    for participant_id in active:
+                        schedule.wake(participant_id, now)
+                    WORKER_WAKEUPS.inc(len(active))
+                    probed_at = now
+                except Exception as e:
+
+                    # Only give up on the probe if the platform (or client) cannot make it at all; anything else is
+                    # likely transient, so that PHQ-9 surveys are not left unnoticed until the next cycle.
+                    if isinstance(e, (AttributeError, TypeError)) or (isinstance(e, LAMP.ApiException) and e.status in [404, 405, 501]):
+                        log.exception("The study-wide activity probe is not supported; relying on the regular checks only.")
+                        probing = False
+                        schedule.max_interval = min(schedule.max_interval, WORKER_INTERVAL)
                     else:
-                        log.warning(f"Skipping; no applicable devices registered for Participant {participant['id']}.")
+                        log.exception("Could not probe the studies for new activity; retrying on the next probe.")
+                        probed_at = now
+
+            # Check the due Participants (without queueing more than there are threads).
+            for participant_id in schedule.due(now, limit=WORKER_THREADS - len(running)):
+                if participant_id in roster:
+                    running[executor.submit(traced_participant, *roster[participant_id])] = participant_id
                 else:
-                    log.info(f"Skipping; already processed an earlier intervention for Participant {participant['id']}.")
+                    schedule.done(participant_id, IDLE, now)
+
+            # Sleep until a check completes or the next Participant, probe or cycle is due.
+            timeouts = [cycle_started + WORKER_INTERVAL - now, digest_sent + SLACK_DIGEST_INTERVAL - now]
+            if probing:
+                timeouts.append(probed_at + SCHEDULER_PROBE_INTERVAL - now)
+            if len(running) < WORKER_THREADS and schedule.wait(now) is not None:
+                timeouts.append(schedule.wait(now))
+            timeout = min(max(min(timeouts), 0.05), 60)
+            if len(running) > 0:
+                finished, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
             else:
-                log.info(f"No interventions to deliver to Participant {participant['id']}.")
-    log.info('Sleeping automations worker...')
-    slack(f"Completed processing.")
+                stopped.wait(timeout)
+                finished = []
+            for future in finished:
+                participant_id = running.pop(future)
+                checks += 1
+                try:
+                    outcome = future.result()
+                    WORKER_PARTICIPANTS.labels('ok').inc()
+                except:
+                    log.exception(f"Processing failed for Participant {participant_id}.")
+                    WORKER_PARTICIPANTS.labels('failed').inc()
+                    outcome, failures = RETRY, failures + 1
+                schedule.done(participant_id, outcome or IDLE)
 
-# Driver code to accept HTTP requests and run the automations worker on repeat.
+# Driver code to accept HTTP requests and run the automations worker in the same process (for development).
+# In production, serve the app with `gunicorn main:app` and run the automations worker with `python worker.py`.
 if __name__ == '__main__':
-    RepeatTimer(3 * 60 * 60, automations_worker).start() # loop: every3h
+    threading.Thread(target=automations_scheduler, daemon=True).start()
     app.run(host='0.0.0.0', port=3000, debug=False)
@@ -0,0 +1,74 @@
+import os
+import time
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+
+# Prometheus metrics shared by the web server and the automations worker.
+# NOTE: With several processes (i.e. gunicorn workers and `python worker.py`), point PROMETHEUS_MULTIPROC_DIR at the
+#       same directory for all of them so that /metrics reports the totals across processes. The metric files are opened
+#       as soon as the metrics below are defined, so the directory is created here if needed; gunicorn removes the files
+#       of processes that are gone when it starts (see gunicorn.conf.py) so that earlier runs are not counted.
+if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+    os.makedirs(os.getenv('PROMETHEUS_MULTIPROC_DIR'), exist_ok=True)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+LAMP_REQUEST_SECONDS = Histogram('lamp_api_request_seconds', "Latency of LAMP API calls.", ['operation'], buckets=LATENCY_BUCKETS)
+LAMP_RESPONSE_ITEMS = Histogram('lamp_api_response_items', "Number of items (i.e. events) returned by LAMP API calls.", ['operation'], buckets=SIZE_BUCKETS)
+LAMP_ERRORS = Counter('lamp_api_errors', "LAMP API calls that failed, by HTTP status (or exception type).", ['operation', 'status'])
+LAMP_RETRIES = Counter('lamp_api_retries', "LAMP API calls that were retried, by the HTTP status (or exception type) of the failure.", ['operation', 'status'])
+LAMP_RATE_LIMIT = Gauge('lamp_api_rate_limit', "Current (shared) rate limit of LAMP API calls per second, as last seen by each process.", multiprocess_mode='all')
+LAMP_THROTTLE_SECONDS = Histogram('lamp_api_throttle_seconds', "Time LAMP API calls waited for the rate limiter.", ['priority'], buckets=LATENCY_BUCKETS)
+
+GATEWAY_REQUEST_SECONDS = Histogram('gateway_request_seconds', "Latency of push gateway requests (each attempt).", ['kind'], buckets=LATENCY_BUCKETS)
+GATEWAY_REQUEST_BYTES = Histogram('gateway_request_bytes', "Size of the JSON bodies sent to the push gateway.", ['kind'], buckets=SIZE_BUCKETS)
+GATEWAY_RESPONSES = Counter('gateway_responses', "Push gateway responses by HTTP status (or exception type).", ['kind', 'status'])
+GATEWAY_PENDING = Gauge('gateway_pending', "Deliveries waiting in the queue.", multiprocess_mode='livesum')
+
+WORKER_PASS_SECONDS = Histogram('worker_pass_seconds', "Duration of automations worker passes.", ['outcome'], buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200))
+WORKER_PARTICIPANTS = Counter('worker_participants_processed', "Participants processed by the automations worker.", ['outcome'])
+WORKER_LAST_SUCCESS = Gauge('worker_last_success_timestamp_seconds', "When the last automations worker pass completed.", multiprocess_mode='max')
+WORKER_SCHEDULED = Gauge('worker_scheduled_participants', "Participants in the automations worker's schedule.", multiprocess_mode='livesum')
+WORKER_WAKEUPS = Counter('worker_wakeups', "Participants checked early because the activity probe found new events.")
+
+METADATA_CACHE_REQUESTS = Counter('metadata_cache_requests', "Lookups in the LAMP metadata cache by kind and result (hit or miss).", ['kind', 'result'])
+METADATA_CACHE_EVICTIONS = Counter('metadata_cache_evictions', "Entries evicted from the LAMP metadata cache to stay within its size.", ['kind'])
+
+HTTP_REQUEST_SECONDS = Histogram('http_request_seconds', "Latency of HTTP requests handled by the app.", ['route', 'method', 'status'], buckets=LATENCY_BUCKETS)
+
+# Middleware (see api.install) that records the latency, response size and errors of every LAMP API call.
+def instrument(operation, function, args, kwargs):
+    started = time.perf_counter()
+    try:
+        result = function(*args, **kwargs)
+    except Exception as e:
+        LAMP_ERRORS.labels(operation, str(getattr(e, 'status', None) or type(e).__name__)).inc()
+        raise
+    finally:
+        LAMP_REQUEST_SECONDS.labels(operation).observe(time.perf_counter() - started)
+    data = result.get('data') if isinstance(result, dict) else None
+    LAMP_RESPONSE_ITEMS.labels(operation).observe(len(data) if isinstance(data, (list, dict)) else 1)
+    return result
+
+# Mark the previous process started under the same name (i.e. the automations worker before it was restarted) as dead
+# in PROMETHEUS_MULTIPROC_DIR, so its live gauges are no longer summed, and remember this one in its place.
+def replace_process(name):
+    path = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if not path:
+        return
+    pid_file = os.path.join(path, f"{name}.pid")
+    if os.path.exists(pid_file):
+        with open(pid_file) as f:
+            previous = f.read().strip()
+        if previous.isdigit() and int(previous) != os.getpid():
+            multiprocess.mark_process_dead(int(previous), path)
+    with open(pid_file, 'w') as f:
+        f.write(str(os.getpid()))
+
+# The metrics of this process, or of every process sharing PROMETHEUS_MULTIPROC_DIR, in the Prometheus text format.
+def exposition():
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR') or os.getenv('prometheus_multiproc_dir'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
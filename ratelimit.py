@@ -0,0 +1,152 @@
+import time
+import random
+import logging
+import threading
+import urllib3
+from metrics import LAMP_RATE_LIMIT, LAMP_RETRIES, LAMP_THROTTLE_SECONDS
+
+log = logging.getLogger(__name__)
+
+# HTTP statuses worth retrying, and the ones that also mean the platform is overloaded and we should slow down.
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+OVERLOADED_STATUS = {429, 502, 503, 504}
+
+# Helper class that paces and retries LAMP API calls, as middleware (see api.install).
+# Calls take a token from a bucket that refills at `rate` per second and holds up to `burst` tokens. The rate adapts
+# to the platform (additive increase, multiplicative decrease): it creeps up by `increase` calls/s after every
+# successful call, drops by 10% whenever a call takes longer than target_latency, and halves on 429 or 5xx responses
+# and connection errors. Interactive calls (i.e. made while handling a web request, as decided by `interactive()`) may
+# use the whole bucket, while background calls leave `reserve` of it untouched, so a busy worker never makes a
+# Participant wait. With a `store` (see store.EventStore), the bucket and the rate live in the store's database, so
+# every process using it (i.e. the web servers and the automations worker) shares them; otherwise they are per process.
+# Calls that failed with a retryable status or a connection error are retried up to `retries` times (once for
+# interactive calls) after a random ("full jitter") delay of up to backoff * 2^attempt seconds. Calls that create
+# something are only retried after a 429, since the platform may have processed them before it failed otherwise.
+class RateLimiter:
+    SCHEMA = """CREATE TABLE IF NOT EXISTS rate_limits (
+        name TEXT PRIMARY KEY,
+        rate REAL NOT NULL,
+        tokens REAL NOT NULL,
+        updated REAL NOT NULL
+    )"""
+
+    def __init__(self, rate=50, max_rate=500, min_rate=1, burst=50, reserve=0.25, increase=0.1, target_latency=2.0, retries=4, backoff=0.5, max_backoff=30, interactive=None, store=None, name='lamp'):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.reserve = reserve
+        self.increase = increase
+        self.target_latency = target_latency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.interactive = interactive or (lambda: False)
+        self.store = store
+        self.name = name
+        self.lock = threading.Lock()
+        self.tokens = burst
+        self.updated = time.time()
+        if self.store is not None:
+            with self.store.connection() as db:
+                db.execute(self.SCHEMA)
+                db.execute('INSERT OR IGNORE INTO rate_limits (name, rate, tokens, updated) VALUES (?, ?, ?, ?)', (name, rate, burst, self.updated))
+        LAMP_RATE_LIMIT.set(rate)
+
+    # Take a token if more than `floor` are left. Returns how long to wait before trying again (0 if one was taken).
+    def take(self, floor):
+        now = time.time()
+        if self.store is None:
+            with self.lock:
+                self.tokens = min(self.burst, self.tokens + max(now - self.updated, 0) * self.rate)
+                self.updated = now
+                if self.tokens >= floor + 1:
+                    self.tokens -= 1
+                    return 0
+                return (floor + 1 - self.tokens) / self.rate
+
+        # Refill and take in a single statement, so concurrent processes never take the same token.
+        db = self.store.connection()
+        with db:
+            taken = db.execute(
+                'UPDATE rate_limits SET tokens = MIN(?, tokens + MAX(? - updated, 0) * rate) - 1, updated = ? WHERE name = ? AND MIN(?, tokens + MAX(? - updated, 0) * rate) >= ?',
+                (self.burst, now, now, self.name, self.burst, now, floor + 1)
+            ).rowcount
+        if taken == 1:
+            return 0
+        rate, tokens, updated = db.execute('SELECT rate, tokens, updated FROM rate_limits WHERE name = ?', (self.name,)).fetchone()
+        self.rate = rate
+        return max((floor + 1 - min(self.burst, tokens + max(now - updated, 0) * rate)) / rate, 0.001)
+
+    # Wait for a token; returns how long that took.
+    def acquire(self, interactive=False):
+        started = time.monotonic()
+        floor = 0 if interactive else self.burst * self.reserve
+        while True:
+            wait = self.take(floor)
+            if wait == 0:
+                return time.monotonic() - started
+            time.sleep(wait)
+
+    # Adapt the rate to how a call went: `failed` calls without a status are connection errors.
+    def feedback(self, seconds, status=None, failed=False):
+        if failed and (status is None or status in OVERLOADED_STATUS or status >= 500):
+            factor, step = 0.5, 0
+        elif seconds > self.target_latency:
+            factor, step = 0.9, 0
+        else:
+            factor, step = 1, self.increase
+        if self.store is None:
+            with self.lock:
+                previous = self.rate
+                self.rate = min(self.max_rate, max(self.min_rate, self.rate * factor + step))
+                rate = self.rate
+        else:
+            db = self.store.connection()
+            with db:
+                previous = db.execute('SELECT rate FROM rate_limits WHERE name = ?', (self.name,)).fetchone()[0]
+                db.execute('UPDATE rate_limits SET rate = MIN(?, MAX(?, rate * ? + ?)) WHERE name = ?', (self.max_rate, self.min_rate, factor, step, self.name))
+                rate = db.execute('SELECT rate FROM rate_limits WHERE name = ?', (self.name,)).fetchone()[0]
+            self.rate = rate
+        if rate != previous:
+            LAMP_RATE_LIMIT.set(rate)
+            if rate < previous / 1.5:
+                log.warning(f"LAMP API is overloaded ({f'HTTP {status}' if status is not None else 'connection error'}); slowing down to {rate:.1f} calls/s.")
+
+    def retryable(self, operation, error):
+        status = getattr(error, 'status', None)
+        if status == 429:
+            return True
+        if operation.endswith('.create'):
+            return False
+        if status in RETRYABLE_STATUS:
+            return True
+        return status is None and isinstance(error, (OSError, urllib3.exceptions.HTTPError))
+
+    def middleware(self, operation, function, args, kwargs):
+        interactive = self.interactive()
+        retries = min(self.retries, 1) if interactive else self.retries
+        attempt = 0
+        while True:
+            waited = self.acquire(interactive)
+            if waited > 0:
+                LAMP_THROTTLE_SECONDS.labels('interactive' if interactive else 'background').observe(waited)
+            started = time.monotonic()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                status = getattr(e, 'status', None)
+                self.feedback(time.monotonic() - started, status, failed=True)
+                if attempt >= retries or not self.retryable(operation, e):
+                    raise
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                retry_after = (getattr(e, 'headers', None) or {}).get('Retry-After')
+                if status == 429 and retry_after is not None and str(retry_after).isdigit():
+                    delay = max(delay, min(int(retry_after), self.max_backoff))
+                LAMP_RETRIES.labels(operation, str(status or type(e).__name__)).inc()
+                log.info(f"Retrying {operation} in {delay:.1f}s after {status or type(e).__name__} (attempt {attempt + 1} of {retries}).")
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self.feedback(time.monotonic() - started)
+            return result
@@ -0,0 +1,298 @@
+import time
+import random
+import sqlite3
+import logging
+import threading
+import LAMP
+
+log = logging.getLogger(__name__)
+
+REGISTERED_USERS_TAG = 'org.digitalpsych.college_study.registered_users'
+
+# Helper class that tracks which email addresses have registered, on behalf of the registered_users Tag.
+# Every known address is kept in a local table (shared by all threads and processes through the event store) and an
+# in-memory set, so a lookup never downloads the Tag. Registrations claim their address with a single INSERT, which
+# makes concurrent signups of the same address fail fast instead of overwriting each other, and confirmed addresses
+# are written back to the Tag in batches. Each write-back is the union of the Tag and every locally known address, so
+# concurrent writers (even in other processes) can never drop each other's entries. With a lease (see sharding.Lease),
+# replicas on different machines also take turns writing it, and a write-back that could not take it is retried later.
+class RegisteredUsers:
+    SCHEMA = """CREATE TABLE IF NOT EXISTS registered_users (
+        email TEXT PRIMARY KEY,
+        registered_at INTEGER NOT NULL,
+        confirmed INTEGER NOT NULL,
+        synced_at INTEGER
+    )"""
+
+    # Claims that were never confirmed (i.e. the process died mid-registration) expire after claim_ttl seconds.
+    def __init__(self, store, researcher, refresh=5 * 60, delay=5, claim_ttl=10 * 60, lease=None):
+        self.store = store
+        self.researcher = researcher
+        self.lease = lease
+        self.refresh_interval = refresh
+        self.delay = delay
+        self.claim_ttl = claim_ttl
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.known = set()
+        self.loaded_at = None
+        self.timer = None
+        with self.store.connection() as db:
+            db.execute(self.SCHEMA)
+
+    # Fold a copy of the Tag that was downloaded at `read_at` into the local table. Addresses that were written to the
+    # Tag before then but are missing from it now were removed on purpose (i.e. to let someone register again).
+    def reconcile(self, remote, read_at):
+        remote_set = set(remote)
+        with self.store.connection() as db:
+            removed = [
+                (email,) for (email,) in db.execute('SELECT email FROM registered_users WHERE synced_at IS NOT NULL AND synced_at < ?', (read_at,))
+                if email not in remote_set
+            ]
+            db.executemany('DELETE FROM registered_users WHERE email = ?', removed)
+            db.executemany('INSERT OR IGNORE INTO registered_users (email, registered_at, confirmed, synced_at) VALUES (?, ?, 1, ?)', [
+                (email, read_at, read_at) for email in remote_set
+            ])
+        if len(removed) > 0:
+            log.info(f"{len(removed)} email addresses were removed from the registered users Tag.")
+
+    # Reload the Tag if the in-memory set is older than the refresh interval.
+    def refresh(self, force=False):
+        if not force and self.loaded_at is not None and time.time() - self.loaded_at < self.refresh_interval:
+            return
+        read_at = int(time.time() * 1000)
+        self.reconcile(LAMP.Type.get_attachment(self.researcher, REGISTERED_USERS_TAG)['data'], read_at)
+        known = {email for (email,) in self.store.connection().execute('SELECT email FROM registered_users')}
+        with self.lock:
+            self.known = known
+            self.loaded_at = time.time()
+
+    # Reserve an address for a registration in progress. Returns False if it was already registered (or is being
+    # registered right now by another request).
+    def claim(self, email):
+        self.refresh()
+        with self.lock:
+            if email in self.known:
+                return False
+        now = int(time.time() * 1000)
+        try:
+            with self.store.connection() as db:
+                db.execute('INSERT INTO registered_users (email, registered_at, confirmed, synced_at) VALUES (?, ?, 0, NULL)', (email, now))
+        except sqlite3.IntegrityError:
+            with self.store.connection() as db:
+                expired = db.execute('UPDATE registered_users SET registered_at = ? WHERE email = ? AND confirmed = 0 AND registered_at < ?', (now, email, now - self.claim_ttl * 1000)).rowcount
+            if expired == 0:
+                with self.lock:
+                    self.known.add(email)
+                return False
+        with self.lock:
+            self.known.add(email)
+        return True
+
+    # Give up a claim whose registration failed so the address can be used again.
+    def release(self, email):
+        with self.store.connection() as db:
+            db.execute('DELETE FROM registered_users WHERE email = ? AND confirmed = 0', (email,))
+        with self.lock:
+            self.known.discard(email)
+
+    # Mark a claimed address as registered and schedule it to be written back with any others confirmed meanwhile.
+    def confirm(self, email):
+        with self.store.connection() as db:
+            db.execute('UPDATE registered_users SET confirmed = 1 WHERE email = ?', (email,))
+        with self.lock:
+            if self.timer is None:
+                self.timer = threading.Timer(self.delay, self.scheduled_flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def scheduled_flush(self):
+        with self.lock:
+            self.timer = None
+        try:
+            if self.flush() is None:
+                with self.lock:
+                    if self.timer is None:
+                        self.timer = threading.Timer(self.delay, self.scheduled_flush)
+                        self.timer.daemon = True
+                        self.timer.start()
+        except:
+            log.exception("Could not write back the registered users Tag; it will be retried on the next flush.")
+
+    # Write every confirmed address that is missing from the Tag back to it. Returns how many were added, or None if
+    # another replica holds the lease.
+    def flush(self):
+        with self.flush_lock:
+            db = self.store.connection()
+            unsynced = db.execute('SELECT email FROM registered_users WHERE confirmed = 1 AND synced_at IS NULL').fetchall()
+            if len(unsynced) == 0:
+                return 0
+            if self.lease is not None and not self.lease.acquire():
+                log.info("Another replica is writing the registered users Tag; deferring the write-back.")
+                return None
+            try:
+                return self.write_back(db, unsynced)
+            finally:
+                if self.lease is not None:
+                    self.lease.release()
+
+    # Add the unsynced addresses (and any other confirmed ones missing from the Tag) to a fresh copy of the Tag.
+    def write_back(self, db, unsynced):
+        read_at = int(time.time() * 1000)
+        remote = LAMP.Type.get_attachment(self.researcher, REGISTERED_USERS_TAG)['data']
+        self.reconcile(remote, read_at)
+        remote_set = set(remote)
+        pending = [
+            email for (email,) in db.execute('SELECT email FROM registered_users WHERE confirmed = 1 ORDER BY registered_at, email')
+            if email not in remote_set
+        ]
+        if len(pending) > 0:
+            LAMP.Type.set_attachment(self.researcher, 'me', REGISTERED_USERS_TAG, remote + pending)
+        with db:
+            db.executemany('UPDATE registered_users SET synced_at = ? WHERE email = ?', [(int(time.time() * 1000), email) for (email,) in unsynced])
+        log.info(f"Wrote {len(pending)} newly registered email addresses to the registered users Tag.")
+        return len(pending)
+
+GIFT_CODES_TAG = 'org.digitalpsych.college_study.gift_codes'
+
+# Helper class that hands out gift card codes from the study registry (the gift_codes Tag, which maps each payout
+# amount to its available codes). The registry is loaded into an in-memory pool once per worker pass, and every code
+# is recorded in a local journal before it is handed out. Consumed codes are removed from the Tag in a single write
+# every `flush_every` allocations and at the end of the pass. Journaled codes never re-enter the pool, even if a crash
+# happened before they were removed from the Tag, so no code can be issued twice (the journal's primary key also
+# guards against other worker processes). Sharded workers (see sharding.Shard) on different machines share no journal,
+# so each of their allocations is written through: under the lease, the code is removed from a fresh copy of the Tag
+# before it is handed out, and a code another replica took meanwhile is skipped. Every replica draws from the whole
+# registry, preferring the codes its shard owns to keep replicas from racing for the same ones.
+class GiftCodes:
+    SCHEMA = """CREATE TABLE IF NOT EXISTS gift_code_journal (
+        code TEXT PRIMARY KEY,
+        amount TEXT NOT NULL,
+        participant TEXT NOT NULL,
+        allocated_at INTEGER NOT NULL,
+        status TEXT NOT NULL
+    )"""
+
+    # With dry_run (i.e. DEBUG_MODE), codes are handed out from the pool but never journaled or removed from the Tag.
+    # Sharded allocations try to take the lease `attempts` times before giving up (and raising a RuntimeError).
+    def __init__(self, store, researcher, flush_every=10, dry_run=False, shard=None, lease=None, attempts=5):
+        self.store = store
+        self.researcher = researcher
+        self.flush_every = flush_every
+        self.dry_run = dry_run
+        self.shard = shard
+        self.lease = lease
+        self.attempts = attempts
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pool = None
+        self.allocated = 0
+        with self.store.connection() as db:
+            db.execute(self.SCHEMA)
+
+    # Load the registry for a new pass. Returns the (code, amount, participant) of any codes that an earlier pass
+    # allocated but never confirmed as delivered, so that someone can follow up on them.
+    def begin(self):
+        self.flush()
+        with self.store.connection() as db:
+            unconfirmed = db.execute("SELECT code, amount, participant FROM gift_code_journal WHERE status = 'allocated'").fetchall()
+            db.execute("UPDATE gift_code_journal SET status = 'unconfirmed' WHERE status = 'allocated'")
+        return unconfirmed
+
+    # Write back the codes allocated during the pass and let other replicas take the lease.
+    def end(self):
+        try:
+            self.flush()
+        finally:
+            if self.lease is not None:
+                self.lease.release()
+
+    # Take an available code of the given amount for the Participant, or None if there are none left.
+    def allocate(self, amount, participant):
+        if self.pool is None:
+            self.flush()
+        code = None
+        with self.lock:
+            available = self.pool.get(amount) or []
+            while len(available) > 0:
+                candidate = available.pop()
+                if self.dry_run:
+                    code = candidate
+                    break
+                if self.lease is not None:
+                    if not self.take(amount, candidate, participant):
+                        continue # Taken by another replica since the pool was loaded.
+                    code = candidate
+                    break
+                try:
+                    with self.store.connection() as db:
+                        db.execute("INSERT INTO gift_code_journal (code, amount, participant, allocated_at, status) VALUES (?, ?, ?, ?, 'allocated')", (candidate, amount, participant, int(time.time() * 1000)))
+                except sqlite3.IntegrityError:
+                    continue # Already handed out, i.e. by another worker process.
+                code = candidate
+                self.allocated += 1
+                break
+            due = self.allocated >= self.flush_every
+        if due:
+            try:
+                self.flush()
+            except:
+                log.exception("Could not write back the gift card code registry; it will be retried on the next flush.")
+        return code
+
+    # Journal the code and remove it from the Tag under the lease; returns False if the code is no longer in the Tag.
+    def take(self, amount, code, participant):
+        for attempt in range(self.attempts):
+            if self.lease.acquire():
+                break
+            time.sleep(random.uniform(1, 2) * self.lease.settle)
+        else:
+            raise RuntimeError(f"Could not take the lease on the gift card code registry to allocate a {amount} code.")
+        try:
+            remote = LAMP.Type.get_attachment(self.researcher, GIFT_CODES_TAG)['data']
+            if code not in (remote.get(amount) or []):
+                return False
+            try:
+                with self.store.connection() as db:
+                    db.execute("INSERT INTO gift_code_journal (code, amount, participant, allocated_at, status) VALUES (?, ?, ?, ?, 'allocated')", (code, amount, participant, int(time.time() * 1000)))
+            except sqlite3.IntegrityError:
+                return False # Already handed out by another worker process on this machine.
+            try:
+                LAMP.Type.set_attachment(self.researcher, 'me', GIFT_CODES_TAG, {key: [x for x in codes if x != code] for key, codes in remote.items()})
+            except:
+                with self.store.connection() as db:
+                    db.execute('DELETE FROM gift_code_journal WHERE code = ?', (code,))
+                raise
+            return True
+        finally:
+            self.lease.release()
+
+    # Record that the code reached the Participant, i.e. the gateway accepted the email carrying it.
+    def delivered(self, code):
+        if not self.dry_run:
+            with self.store.connection() as db:
+                db.execute("UPDATE gift_code_journal SET status = 'delivered' WHERE code = ?", (code,))
+
+    # Remove every journaled code from the Tag (keeping any codes added to it meanwhile) and reload the pool from it.
+    def flush(self):
+        with self.flush_lock:
+            remote = LAMP.Type.get_attachment(self.researcher, GIFT_CODES_TAG)['data']
+            journaled = {code for (code,) in self.store.connection().execute('SELECT code FROM gift_code_journal')}
+            available = {amount: [code for code in codes if code not in journaled] for amount, codes in remote.items()}
+            consumed = sum(len(codes) for codes in remote.values()) - sum(len(codes) for codes in available.values())
+            if consumed > 0 and not self.dry_run:
+                if self.lease is not None and not self.lease.acquire():
+                    log.info(f"Another replica is writing the gift card code registry; deferring the removal of {consumed} codes.")
+                else:
+                    LAMP.Type.set_attachment(self.researcher, 'me', GIFT_CODES_TAG, available)
+                    log.info(f"Removed {consumed} allocated codes from the gift card code registry.")
+
+            # Codes allocated while the Tag was being written are not in the snapshot above, so check the journal again.
+            # The codes this shard owns go last, since allocations pop them from the end.
+            with self.lock:
+                journaled = {code for (code,) in self.store.connection().execute('SELECT code FROM gift_code_journal')}
+                self.pool = {
+                    amount: sorted([code for code in codes if code not in journaled], key=lambda code: self.shard is not None and self.shard.owns(code))
+                    for amount, codes in available.items()
+                }
+                self.allocated = 0
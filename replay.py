@@ -0,0 +1,225 @@
+import os
+import sys
+import json
+import mmap
+import time
+import zlib
+import shutil
+import struct
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+import requests
+import LAMP
+
+log = logging.getLogger(__name__)
+
+# Traffic archives hold one zlib-compressed JSON record per call, followed by an index of (sha1 of the call's key,
+# occurrence, offset, length) entries sorted by key and occurrence, and a footer pointing at the index:
+#   MAGIC | record... | index entry... | index offset (8 bytes) | index entries (4 bytes) | MAGIC
+MAGIC = b'LAMPREC1'
+ENTRY = struct.Struct('>20sIQI')
+FOOTER = struct.Struct('>QI')
+
+# Arguments that name a point in time (i.e. the end of an ingest window, computed from the clock), which are left out of
+# the key so a replayed pass matches the recorded one whenever it runs.
+TIME_ARGUMENTS = ['_from', 'to']
+
+# Methods whose last argument is the value written, which is left out of the key too: it often depends on the clock or
+# on the order of concurrent work (i.e. which gift card code was drawn), while the answer does not depend on it.
+WRITE_METHODS = ['set_attachment', 'create', 'update']
+
+# The key of a LAMP API call (or a gateway request when the operation is "gateway") in the archive.
+def call_key(operation, args, kwargs):
+    if operation.split('.')[-1] in WRITE_METHODS:
+        args = args[:-1]
+    kwargs = {name: value for name, value in kwargs.items() if name not in TIME_ARGUMENTS}
+    key = json.dumps([operation, list(args), kwargs], sort_keys=True, default=str)
+    return hashlib.sha1(key.encode()).digest()
+
+# Gateway requests are keyed by their recipient only, since their content is written like a Tag's value.
+def gateway_key(data):
+    return call_key('gateway', [json.loads(data).get('device_token')], {})
+
+# Helper class that records every LAMP API call (as middleware, see api.install) and push gateway request (by wrapping
+# the gateway's POST, see DeliveryQueue) of this process into a traffic archive, along with how long each one took.
+# The index is only written by close() (registered with atexit by main.py), so an interrupted recording is unusable.
+class Recorder:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.entries = []
+
+    def record(self, key, record):
+        data = zlib.compress(json.dumps(record, default=str).encode())
+        with self.lock:
+            if self.file is None:
+                return
+            occurrence = self.counts.get(key, 0)
+            self.counts[key] = occurrence + 1
+            self.entries.append((key, occurrence, self.file.tell(), len(data)))
+            self.file.write(data)
+
+    def middleware(self, operation, function, args, kwargs):
+        started = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        except LAMP.ApiException as e:
+            self.record(call_key(operation, args, kwargs), {'seconds': time.perf_counter() - started, 'error': {
+                'status': e.status, 'reason': e.reason, 'headers': dict(e.headers) if getattr(e, 'headers', None) else None,
+            }})
+            raise
+        except Exception as e:
+            self.record(call_key(operation, args, kwargs), {'seconds': time.perf_counter() - started, 'error': {'exception': repr(e)}})
+            raise
+        self.record(call_key(operation, args, kwargs), {'seconds': time.perf_counter() - started, 'result': result})
+        return result
+
+    # Wrap a requests-style post(url, data=..., timeout=...) function.
+    def gateway(self, post):
+        def recorded(url, data=None, **kwargs):
+            started = time.perf_counter()
+            try:
+                response = post(url, data=data, **kwargs)
+            except requests.RequestException as e:
+                self.record(gateway_key(data), {'seconds': time.perf_counter() - started, 'error': {'exception': repr(e)}})
+                raise
+            self.record(gateway_key(data), {'seconds': time.perf_counter() - started, 'status': response.status_code, 'content': response.text})
+            return response
+        return recorded
+
+    def close(self):
+        with self.lock:
+            if self.file is None:
+                return
+            index = self.file.tell()
+            for entry in sorted(self.entries):
+                self.file.write(ENTRY.pack(*entry))
+            self.file.write(FOOTER.pack(index, len(self.entries)) + MAGIC)
+            self.file.close()
+            self.file = None
+        log.info(f"Recorded {len(self.entries)} calls to {self.path}.")
+
+# Helper class that answers LAMP API calls and push gateway requests from a traffic archive instead of the network.
+# The archive is memory-mapped and searched in place, so opening it is instant and only the records that are used are
+# ever read. The nth call with a given key gets the nth recorded answer (and the last one once they run out), taking
+# as long as the recording did with latency='original' or returning right away with latency='zero'. Calls that were
+# never recorded raise a ReplayMiss.
+# NOTE: Replaying only matches the recording when it starts from the same event store (see snapshot()).
+class Replayer:
+    def __init__(self, path, latency='original'):
+        self.path = path
+        self.latency = latency
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC or self.data[-len(MAGIC):] != MAGIC:
+            raise ValueError(f"{path} is not a complete traffic archive.")
+        self.index, self.count = FOOTER.unpack_from(self.data, len(self.data) - len(MAGIC) - FOOTER.size)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.misses = 0
+
+    # The position of the first index entry that is not less than (key, occurrence).
+    def search(self, key, occurrence):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if ENTRY.unpack_from(self.data, self.index + middle * ENTRY.size)[:2] < (key, occurrence):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def lookup(self, key):
+        with self.lock:
+            occurrence = self.counts.get(key, 0)
+            self.counts[key] = occurrence + 1
+        position = self.search(key, occurrence)
+        entry = ENTRY.unpack_from(self.data, self.index + position * ENTRY.size) if position < self.count else None
+        if entry is None or entry[0] != key:
+            entry = ENTRY.unpack_from(self.data, self.index + (position - 1) * ENTRY.size) if position > 0 else None
+            if entry is None or entry[0] != key:
+                with self.lock:
+                    self.misses += 1
+                return None
+        record = json.loads(zlib.decompress(self.data[entry[2]:entry[2] + entry[3]]))
+        if self.latency == 'original':
+            time.sleep(record['seconds'])
+        return record
+
+    def middleware(self, operation, function, args, kwargs):
+        record = self.lookup(call_key(operation, args, kwargs))
+        if record is None:
+            raise ReplayMiss(f"{operation} was not recorded with these arguments.")
+        if 'result' in record:
+            return record['result']
+        if 'status' in record['error']:
+            error = LAMP.ApiException(status=record['error']['status'], reason=record['error']['reason'])
+            error.headers = record['error']['headers']
+            raise error
+        raise ConnectionError(record['error']['exception'])
+
+    # Wrap a requests-style post(url, data=..., timeout=...) function; the gateway is never contacted.
+    def gateway(self, post):
+        def replayed(url, data=None, **kwargs):
+            record = self.lookup(gateway_key(data))
+            if record is None:
+                raise ReplayMiss("This gateway request was not recorded.")
+            if 'error' in record:
+                raise requests.ConnectionError(record['error']['exception'])
+            response = requests.Response()
+            response.status_code = record['status']
+            response._content = record['content'].encode()
+            response.url = url
+            return response
+        return replayed
+
+    def close(self):
+        if self.misses > 0:
+            log.warning(f"{self.misses} calls were not found in {self.path}.")
+        self.data.close()
+        self.file.close()
+
+class ReplayMiss(Exception):
+    pass
+
+# Copy the event store (consistently, even while it is in use) so a replay can start from the recorded state.
+def snapshot(source, destination):
+    with sqlite3.connect(source) as db, sqlite3.connect(destination) as copy:
+        db.backup(copy)
+
+# Driver code to record a single automations worker pass, or to replay one (from a fresh copy of the event store it
+# started with) and print how long it took:
+#   python replay.py record traffic.lamprec
+#   python replay.py replay traffic.lamprec [original|zero]
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ['record', 'replay']:
+        print(f"usage: {sys.argv[0]} record|replay <archive> [original|zero]")
+        sys.exit(2)
+    mode, path = sys.argv[1], sys.argv[2]
+    if mode == 'record':
+        if os.path.exists(os.getenv("EVENT_STORE_PATH", "college_study.db")):
+            snapshot(os.getenv("EVENT_STORE_PATH", "college_study.db"), f"{path}.db")
+        os.environ['TRAFFIC_RECORD_PATH'] = path
+    else:
+        directory = tempfile.mkdtemp()
+        os.environ['EVENT_STORE_PATH'] = os.path.join(directory, 'college_study.db')
+        if os.path.exists(f"{path}.db"):
+            shutil.copyfile(f"{path}.db", os.environ['EVENT_STORE_PATH'])
+        os.environ['TRAFFIC_REPLAY_PATH'] = path
+        os.environ['TRAFFIC_REPLAY_LATENCY'] = sys.argv[3] if len(sys.argv) > 3 else 'original'
+        if os.environ['TRAFFIC_REPLAY_LATENCY'] == 'zero':
+            os.environ.setdefault('LAMP_RATE', '100000')
+            os.environ.setdefault('LAMP_MAX_RATE', '100000')
+    import main
+    started = time.perf_counter()
+    main.automations_worker()
+    main.DELIVERY.flush(60)
+    print(json.dumps({'mode': mode, 'seconds': round(time.perf_counter() - started, 3), 'misses': getattr(main.TRAFFIC, 'misses', None)}))
+    if mode == 'replay':
+        shutil.rmtree(directory, ignore_errors=True)
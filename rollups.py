@@ -0,0 +1,128 @@
+import heapq
+
+MILLISECONDS_PER_DAY = 24 * 60 * 60 * 1000
+MILLISECONDS_PER_WEEK = 7 * MILLISECONDS_PER_DAY
+
+# 1970-01-01 was a Thursday, so weeks (starting on Monday) are offset by four days from the epoch.
+WEEK_OFFSET = 4 * MILLISECONDS_PER_DAY
+
+# Journal text shown per bucket once entries are rolled up.
+PREVIEW_LENGTH = 140
+
+ROLLUP_MODES = ['raw', 'daily', 'weekly', 'lttb', 'auto']
+
+# Helper class for one summary graph series: its time-sorted raw points ([x, y] or [x, y, text]) and a rollup per UTC
+# day of [count, sum, min, max, latest x, latest text]. Both only ever grow, so new events just touch the latest
+# buckets; the whole thing is a plain JSON value that can be kept in the event store between requests. The raw points
+# are only kept while there are at most `limit` of them (or always without a limit): past that, only the rollups are
+# rendered anyway, so the state stays proportional to the number of days rather than the number of events.
+class Series:
+    def __init__(self, state=None, limit=None):
+        state = state or {'points': [], 'days': {}}
+        self.points = state['points']
+        self.days = state['days']
+        self.limit = limit
+        self.count = sum(bucket[0] for bucket in self.days.values())
+
+    def state(self):
+        return {'points': self.points, 'days': self.days}
+
+    def add(self, x, y, text=None):
+        self.extend([[x, y] if text is None else [x, y, text]])
+
+    # Add a batch of points in any order (i.e. one chunk of events, which arrive newest first). Batches older than the
+    # latest point are merged in a single pass instead of sorting all the points again.
+    def extend(self, points):
+        points = sorted(points, key=lambda p: p[0])
+        self.count += len(points)
+        if self.limit is not None and self.count > self.limit:
+            self.points = []
+        elif len(points) > 0 and len(self.points) > 0 and points[0][0] < self.points[-1][0]:
+            self.points[:] = heapq.merge(self.points, points, key=lambda p: p[0])
+        else:
+            self.points.extend(points)
+
+        for point in points:
+            x, y = point[0], point[1]
+
+            # Buckets only ever show a preview of their text, so keep no more than is needed to tell it was cut.
+            text = point[2][:PREVIEW_LENGTH + 1] if len(point) > 2 and point[2] is not None else None
+            key = str(x - x % MILLISECONDS_PER_DAY)
+            bucket = self.days.get(key)
+            if bucket is None:
+                self.days[key] = [1, y, y, y, x, text]
+            else:
+                bucket[0] += 1
+                bucket[1] += y
+                bucket[2] = min(bucket[2], y)
+                bucket[3] = max(bucket[3], y)
+                if x >= bucket[4]:
+                    bucket[4], bucket[5] = x, text
+
+    # Daily or weekly rollups as points with the bucket mean as "y", its "min"/"max" band and the number of values "n".
+    def buckets(self, size):
+        merged = {}
+        for key, (count, total, low, high, latest, text) in self.days.items():
+            day = int(key)
+            start = day if size == MILLISECONDS_PER_DAY else day - (day - WEEK_OFFSET) % size
+            bucket = merged.get(start)
+            if bucket is None:
+                merged[start] = [count, total, low, high, latest, text]
+            else:
+                bucket[0] += count
+                bucket[1] += total
+                bucket[2] = min(bucket[2], low)
+                bucket[3] = max(bucket[3], high)
+                if latest >= bucket[4]:
+                    bucket[4], bucket[5] = latest, text
+        result = []
+        for start in sorted(merged):
+            count, total, low, high, _, text = merged[start]
+            point = {"x": start, "y": total / count, "min": low, "max": high, "n": count}
+            if text is not None:
+                point["t"] = text if len(text) <= PREVIEW_LENGTH else text[:PREVIEW_LENGTH - 1] + "…"
+            result.append(point)
+        return result
+
+    def raw(self):
+        return [{"x": p[0], "y": p[1]} if len(p) == 2 else {"x": p[0], "y": p[1], "t": p[2]} for p in self.points]
+
+    # The series as at most `target` points (except in raw mode). The auto mode uses the finest resolution that fits:
+    # raw points, then daily and weekly rollups, and finally LTTB over the weekly rollups.
+    def render(self, mode='auto', target=200):
+        if mode == 'raw':
+            return self.raw()
+        elif mode == 'daily':
+            return lttb(self.buckets(MILLISECONDS_PER_DAY), target)
+        elif mode == 'weekly':
+            return lttb(self.buckets(MILLISECONDS_PER_WEEK), target)
+        elif mode == 'lttb':
+            return lttb(self.raw(), target)
+        if self.count <= target:
+            return self.raw()
+        if len(self.days) <= target:
+            return self.buckets(MILLISECONDS_PER_DAY)
+        return lttb(self.buckets(MILLISECONDS_PER_WEEK), target)
+
+# Largest-Triangle-Three-Buckets downsampling of time-sorted {"x", "y", ...} points: keeps the first and last points
+# and, from each of the (target - 2) buckets in between, the point forming the largest triangle with its neighbours.
+def lttb(points, target):
+    if target >= len(points) or target < 3:
+        return points
+    sampled = [points[0]]
+    size = (len(points) - 2) / (target - 2)
+    previous = points[0]
+    for i in range(target - 2):
+        start, end = int(i * size) + 1, int((i + 1) * size) + 1
+        following = points[end:min(int((i + 2) * size) + 1, len(points) - 1)] or [points[-1]]
+        average_x = sum(p["x"] for p in following) / len(following)
+        average_y = sum(p["y"] for p in following) / len(following)
+        best, best_area = None, -1
+        for point in points[start:end]:
+            area = abs((previous["x"] - average_x) * (point["y"] - previous["y"]) - (previous["x"] - point["x"]) * (average_y - previous["y"]))
+            if area > best_area:
+                best, best_area = point, area
+        sampled.append(best)
+        previous = best
+    sampled.append(points[-1])
+    return sampled
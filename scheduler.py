@@ -0,0 +1,100 @@
+import time
+import heapq
+import threading
+
+# Outcomes of processing a Participant, which decide when they are checked again.
+ACTIVE = 'active' # new events were processed
+IDLE = 'idle' # nothing new since the last check
+RETRY = 'retry' # an automation could not complete (i.e. no device registered yet) or the check failed
+FINISHED = 'finished' # the Participant completed the study
+
+# Helper class for a priority queue of Participants ordered by when they are next due to be checked. Participants who
+# just had new events are checked again after min_interval; every check that finds nothing new doubles their interval
+# up to max_interval, and finished Participants stay at max_interval. Pending automations back off the same way, but
+# at most to a quarter of max_interval. wake() makes a Participant due right away (i.e. when new activity was seen),
+# or right after the check in progress. Heap items are never removed: rescheduling pushes a new version of the entry
+# and stale versions are skipped when they come up.
+class Scheduler:
+    def __init__(self, min_interval=5 * 60, max_interval=3 * 60 * 60):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.lock = threading.Lock()
+        self.heap = []
+        self.entries = {}
+        self.version = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def push(self, key, due, interval):
+        self.version += 1
+        self.entries[key] = {'due': due, 'interval': interval, 'version': self.version, 'running': False, 'woken': False}
+        heapq.heappush(self.heap, (due, key, self.version))
+
+    # Track new keys (due right away) and forget the ones that are gone (i.e. withdrawn or moved to another shard).
+    def retain(self, keys, now=None):
+        now = now if now is not None else time.time()
+        keys = set(keys)
+        with self.lock:
+            for key in list(self.entries):
+                if key not in keys:
+                    del self.entries[key]
+            for key in keys:
+                if key not in self.entries:
+                    self.push(key, now, self.min_interval)
+            if len(self.heap) > 2 * len(self.entries) + 64:
+                self.heap = [(entry['due'], key, entry['version']) for key, entry in self.entries.items() if not entry['running']]
+                heapq.heapify(self.heap)
+
+    def wake(self, key, now=None):
+        now = now if now is not None else time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            if entry['running']:
+                entry['woken'] = True
+            elif entry['due'] > now:
+                self.push(key, now, self.min_interval)
+
+    # Pop the keys that are due (at most `limit`); each must be handed back with done() once it was checked.
+    def due(self, now=None, limit=None):
+        now = now if now is not None else time.time()
+        keys = []
+        with self.lock:
+            while len(self.heap) > 0 and self.heap[0][0] <= now and (limit is None or len(keys) < limit):
+                _, key, version = heapq.heappop(self.heap)
+                entry = self.entries.get(key)
+                if entry is None or entry['version'] != version:
+                    continue # Rescheduled or forgotten since it was pushed.
+                entry['running'] = True
+                keys.append(key)
+        return keys
+
+    def done(self, key, outcome, now=None):
+        now = now if now is not None else time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or not entry['running']:
+                return
+            if outcome == ACTIVE or entry['woken']:
+                interval = self.min_interval
+            elif outcome == FINISHED:
+                interval = self.max_interval
+            elif outcome == RETRY:
+                interval = min(entry['interval'] * 2, max(self.max_interval // 4, self.min_interval))
+            else:
+                interval = min(entry['interval'] * 2, self.max_interval)
+            self.push(key, now if entry['woken'] else now + interval, interval)
+
+    # Seconds until the next key is due (or None if there are none).
+    def wait(self, now=None):
+        now = now if now is not None else time.time()
+        with self.lock:
+            while len(self.heap) > 0:
+                due, key, version = self.heap[0]
+                entry = self.entries.get(key)
+                if entry is not None and entry['version'] == version:
+                    return max(due - now, 0)
+                heapq.heappop(self.heap)
+        return None
@@ -0,0 +1,78 @@
+import threading
+from collections import namedtuple
+from collections.abc import Hashable
+
+LIKERT_OPTIONS = ["0", "1", "2", "3"] # this + below = temporary patch
+REVERSE_CODING = ["i was able to function well today", "today I could handle what came my way"]
+
+# Weekly scores only consider question #9 (PHQ-9 suicide, slice 8:9).
+def weekly_score(event):
+    return sum(map(lambda slice: LIKERT_OPTIONS.index(slice['value']) if slice.get('value', None) in LIKERT_OPTIONS else 0, event['temporal_slices'][8:9]))
+
+# Daily scores sum every question; the questions to be reverse coded (lowercase-matched) are also flipped.
+def daily_score(event):
+    return sum(map(lambda slice: (((-len(LIKERT_OPTIONS) if slice.get('item', None) in REVERSE_CODING else 0) + LIKERT_OPTIONS.index(slice['value'])) if slice.get('value', None) in LIKERT_OPTIONS else 0), event['temporal_slices']))
+
+# How a single survey question is scored: its question type, a map from each option to its score (for list, slider
+# and rating questions), whether it is reverse coded, and the graph category (suffixed with the survey name) it joins.
+Question = namedtuple('Question', ['type', 'options', 'reverse', 'category'])
+
+# Compile a survey Activity and its "cortex.question_categories" attachment into a table from question text to Question.
+def compile_survey(survey, question_cats):
+    table = {}
+    for question_info in survey.get('settings') or []:
+        text = question_info.get('text')
+        if not isinstance(text, Hashable) or text in table:
+            continue # Answers are matched to the first question with the same text.
+
+        # Options are scored by their position; a repeated option keeps its last position, as a linear scan would.
+        options = {}
+        if question_info.get('type') in ["list", "slider", "rating"]:
+            choices = question_info.get('options') or []
+            for option_index, option in enumerate(choices):
+                if len(choices) > 1 and isinstance(option, Hashable):
+                    options[option] = option_index * 3 / (len(choices) - 1)
+
+        if text in question_cats:
+            table[text] = Question(question_info.get('type'), options, bool(question_cats[text]['reverse']), f"{question_cats[text]['category']} ({survey['name']})")
+        else:
+            table[text] = Question(question_info.get('type'), options, False, f"_unmatched ({survey['name']})")
+    return table
+
+# Score a single answer to a compiled Question, or None if it cannot be scored (text, multi-select, missing options).
+def score_answer(question, value):
+    if question.type == "likert":
+        try:
+            return float(value)
+        except Exception:
+            return None
+    elif question.type == "boolean" and value is not None:
+        return {"no": 0.0, "yes": 3.0}.get(value.lower()) # no is healthy in standard scoring, yes in reverse scoring
+    elif question.type in ["list", "slider", "rating"] and value is not None:
+        return question.options.get(value) if isinstance(value, Hashable) else None
+    return None
+
+# Helper class that caches compiled survey tables across requests. Each table is stored with the Activity and question
+# categories it was compiled from, which come from the metadata cache (see cache.MetadataCache), and is recompiled as
+# soon as either of them is a different object, i.e. once that cache reloaded it; comparing identities keeps a hit cheap.
+class SurveyTables:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tables = {}
+
+    def get(self, survey, question_cats):
+        with self.lock:
+            entry = self.tables.get(survey['id'])
+        if entry is not None and entry[0] is survey and entry[1] is question_cats:
+            return entry[2]
+        table = compile_survey(survey, question_cats)
+        with self.lock:
+            self.tables[survey['id']] = (survey, question_cats, table)
+        return table
+
+    def invalidate(self, activity=None):
+        with self.lock:
+            if activity is None:
+                self.tables.clear()
+            else:
+                self.tables.pop(activity, None)
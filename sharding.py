@@ -0,0 +1,78 @@
+import os
+import time
+import socket
+import hashlib
+import logging
+import threading
+import LAMP
+
+log = logging.getLogger(__name__)
+
+LEASE_TAG = 'org.digitalpsych.college_study.lease'
+
+# Helper class that assigns keys (i.e. Participant IDs or gift card codes) to one of `count` shards with rendezvous
+# (highest random weight) hashing: every key goes to the shard with the largest hash of (shard, key). This is stable
+# across processes and machines, and when the shard count changes only the keys of the added or removed shards move
+# (about 1/count of them) instead of almost all of them, so most replicas keep their local state warm.
+class Shard:
+    def __init__(self, index=0, count=1):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"Shard index {index} is out of range for {count} shards.")
+        self.index = index
+        self.count = count
+
+    def owner(self, key):
+        return max(range(self.count), key=lambda shard: hashlib.sha1(f"{shard}:{key}".encode()).digest())
+
+    def owns(self, key):
+        return self.count == 1 or self.owner(key) == self.index
+
+    def __str__(self):
+        return f"{self.index}/{self.count}"
+
+# Helper class for a named lease shared by every replica (on any machine) through a Tag on the researcher, so that only
+# one of them writes a shared researcher-level Tag at a time. The LAMP API has no compare-and-swap, so a lease is taken
+# by writing it and reading it back after `settle` seconds: of several replicas racing for a free lease, only the last
+# writer sees itself and proceeds. A holder keeps the lease until release() or until it expires after `ttl` seconds
+# (i.e. if it crashed), and renews it for free while more than half of that remains.
+class Lease:
+    def __init__(self, researcher, name, holder=None, ttl=5 * 60, settle=2):
+        self.researcher = researcher
+        self.tag = f"{LEASE_TAG}.{name}"
+        self.holder = holder or f"{socket.gethostname()}:{os.getpid()}"
+        self.ttl = ttl
+        self.settle = settle
+        self.lock = threading.Lock()
+        self.expires = 0
+
+    def read(self):
+        try:
+            return LAMP.Type.get_attachment(self.researcher, self.tag)['data'] or {}
+        except LAMP.ApiException:
+            return {} # 404 error if the Tag has never been created before.
+
+    # Take (or renew) the lease; returns False if another replica holds it.
+    def acquire(self):
+        with self.lock:
+            now = time.time() * 1000
+            if self.expires - now > self.ttl * 1000 / 2:
+                return True
+            current = self.read()
+            if current.get('holder') not in (None, self.holder) and current.get('expires', 0) > now:
+                return False
+            expires = now + self.ttl * 1000
+            LAMP.Type.set_attachment(self.researcher, 'me', self.tag, {'holder': self.holder, 'expires': expires})
+            time.sleep(self.settle)
+            if self.read().get('holder') != self.holder:
+                log.info(f"Lost the race for lease {self.tag} to another replica.")
+                return False
+            self.expires = expires
+            return True
+
+    def release(self):
+        with self.lock:
+            if self.expires == 0:
+                return
+            self.expires = 0
+            if self.read().get('holder') == self.holder:
+                LAMP.Type.set_attachment(self.researcher, 'me', self.tag, {})
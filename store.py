@@ -0,0 +1,199 @@
+import json
+import time
+import secrets
+import sqlite3
+import logging
+import threading
+import LAMP
+import ingest
+
+log = logging.getLogger(__name__)
+
+MILLISECONDS_PER_DAY = 24 * 60 * 60 * 1000
+
+# Helper class for an on-disk copy of every Participant's ActivityEvents that is kept in sync through incremental pulls.
+# Each event is stored once per (participant, activity, timestamp) and gets a monotonic sequence number (its rowid),
+# so every consumer can track what it has already processed independently of the event timestamps themselves.
+# NOTE: The database is opened in WAL mode so the web server and the automations worker (even in separate processes)
+#       can read while a sync is writing.
+class EventStore:
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS activity_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            participant TEXT NOT NULL,
+            activity TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            UNIQUE (participant, activity, timestamp)
+        )""",
+        "CREATE INDEX IF NOT EXISTS activity_events_by_time ON activity_events (participant, timestamp)",
+        "CREATE INDEX IF NOT EXISTS activity_events_by_sequence ON activity_events (participant, id)",
+        """CREATE TABLE IF NOT EXISTS sync_state (
+            participant TEXT PRIMARY KEY,
+            watermark INTEGER,
+            synced_at INTEGER NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS participant_state (
+            participant TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (participant, key)
+        )""",
+        """CREATE TABLE IF NOT EXISTS specs (
+            participant TEXT PRIMARY KEY,
+            version TEXT NOT NULL,
+            spec TEXT NOT NULL,
+            built_at INTEGER NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS summary_tokens (
+            token TEXT PRIMARY KEY,
+            participant TEXT NOT NULL,
+            expires INTEGER NOT NULL
+        )""",
+    ]
+
+    # Events uploaded late (i.e. a phone that was offline) can carry timestamps older than the watermark,
+    # so each incremental pull looks back this far; the UNIQUE constraint drops the events already stored.
+    # Pulls are streamed (see ingest.stream) with the given page_size and the platform's page_limit, if any, and never
+    # reach back before `earliest` (in ms).
+    def __init__(self, path, overlap=MILLISECONDS_PER_DAY, page_size=1000, page_limit=None, earliest=0):
+        self.path = path
+        self.overlap = overlap
+        self.page_size = page_size
+        self.page_limit = page_limit
+        self.earliest = earliest
+        self.local = threading.local()
+        with self.connection() as db:
+            for statement in self.SCHEMA:
+                db.execute(statement)
+
+    # SQLite connections cannot be shared across threads, so each thread lazily opens its own.
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+        return db
+
+    # Pull every event newer than the stored watermark (the whole history the first time) and return how many were new.
+    # With max_age (in seconds), Participants that were synced that recently are not pulled again.
+    # NOTE: Each page is stored as it arrives, but the watermark only moves once the pull completed, so an interrupted
+    #       pull is simply repeated (and the events it already stored are ignored).
+    def sync(self, participant, max_age=None):
+        db = self.connection()
+        row = db.execute('SELECT watermark, synced_at FROM sync_state WHERE participant = ?', (participant,)).fetchone()
+        if row is not None and max_age is not None and time.time() * 1000 - row[1] < max_age * 1000:
+            return 0
+        watermark = row[0] if row is not None else None
+
+        added, started = 0, int(time.time() * 1000)
+        pages = ingest.stream(LAMP.ActivityEvent.all_by_participant, participant, _from=watermark - self.overlap if watermark is not None else None, page_size=self.page_size, page_limit=self.page_limit, earliest=self.earliest)
+        for events in pages:
+            with db:
+                before = db.total_changes
+                db.executemany('INSERT OR IGNORE INTO activity_events (participant, activity, timestamp, data) VALUES (?, ?, ?, ?)', [
+                    (participant, event.get('activity') or '', event['timestamp'], json.dumps(event)) for event in events
+                ])
+                added += db.total_changes - before
+            watermark = max([event['timestamp'] for event in events] + ([watermark] if watermark is not None else []))
+
+        # A Participant without any events yet is pulled from when this pull started next time, not from the start.
+        watermark = watermark if watermark is not None else started
+        with db:
+            db.execute('INSERT OR REPLACE INTO sync_state (participant, watermark, synced_at) VALUES (?, ?, ?)', (participant, watermark, int(time.time() * 1000)))
+        if added > 0:
+            log.debug(f"Stored {added} new events for Participant {participant}.")
+        return added
+
+    # The events stored after the sequence number `after` up to `until` (everything by default), newest first (the
+    # same order as the LAMP API), in lists of at most page_size events. Each chunk is a separate query that continues
+    # after the last (timestamp, id) of the previous one, so no statement stays open while the caller works.
+    # With _from and/or to (in ms, inclusive, like the LAMP API), only the events timestamped within that range are read.
+    def chunks(self, participant, after=0, until=None, _from=None, to=None):
+        until = until if until is not None else self.sequence(participant)
+        chunk = self.page_size
+        db, last = self.connection(), None
+        query, bounds = 'SELECT id, timestamp, data FROM activity_events WHERE participant = ? AND id > ? AND id <= ?', (participant, after, until)
+        if _from is not None:
+            query, bounds = query + ' AND timestamp >= ?', bounds + (_from,)
+        if to is not None:
+            query, bounds = query + ' AND timestamp <= ?', bounds + (to,)
+        while True:
+            if last is None:
+                rows = db.execute(query + ' ORDER BY timestamp DESC, id DESC LIMIT ?', bounds + (chunk,)).fetchall()
+            else:
+                rows = db.execute(query + ' AND (timestamp < ? OR (timestamp = ? AND id < ?)) ORDER BY timestamp DESC, id DESC LIMIT ?', bounds + (last[1], last[1], last[0], chunk)).fetchall()
+            if len(rows) == 0:
+                return
+            yield [json.loads(data) for (_, _, data) in rows]
+            last = rows[-1]
+
+    # The latest sequence number stored for a Participant; it changes whenever any of their events do.
+    def sequence(self, participant):
+        return self.connection().execute('SELECT MAX(id) FROM activity_events WHERE participant = ?', (participant,)).fetchone()[0] or 0
+
+    # Small JSON values that consumers (i.e. the automations worker) keep per Participant across restarts.
+    def get_state(self, participant, key):
+        row = self.connection().execute('SELECT value FROM participant_state WHERE participant = ? AND key = ?', (participant, key)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put_state(self, participant, key, value):
+        with self.connection() as db:
+            db.execute('INSERT OR REPLACE INTO participant_state (participant, key, value) VALUES (?, ?, ?)', (participant, key, json.dumps(value)))
+
+    # Pre-rendered (JSON) summary specs along with the data version they were built from.
+    def get_spec(self, participant):
+        row = self.connection().execute('SELECT version, spec, built_at FROM specs WHERE participant = ?', (participant,)).fetchone()
+        return {'version': row[0], 'spec': row[1], 'built_at': row[2]} if row is not None else None
+
+    def put_spec(self, participant, version, spec):
+        built_at = int(time.time() * 1000)
+        with self.connection() as db:
+            db.execute('INSERT OR REPLACE INTO specs (participant, version, spec, built_at) VALUES (?, ?, ?, ?)', (participant, version, spec, built_at))
+        return {'version': version, 'spec': spec, 'built_at': built_at}
+
+    # Opaque, expiring tokens that let a logged-in Participant fetch their summary spec without putting their
+    # Participant ID (which doubles as their password) in a URL.
+    def issue_token(self, participant, ttl):
+        token = secrets.token_urlsafe(24)
+        with self.connection() as db:
+            db.execute('INSERT INTO summary_tokens (token, participant, expires) VALUES (?, ?, ?)', (token, participant, int((time.time() + ttl) * 1000)))
+        return token
+
+    def resolve_token(self, token):
+        row = self.connection().execute('SELECT participant FROM summary_tokens WHERE token = ? AND expires > ?', (token, int(time.time() * 1000))).fetchone()
+        return row[0] if row is not None else None
+
+    # Drop everything known about a Participant (including consumer state derived from it) and pull the full history again.
+    def resync(self, participant):
+        with self.connection() as db:
+            db.execute('DELETE FROM activity_events WHERE participant = ?', (participant,))
+            db.execute('DELETE FROM sync_state WHERE participant = ?', (participant,))
+            db.execute('DELETE FROM participant_state WHERE participant = ?', (participant,))
+            db.execute('DELETE FROM specs WHERE participant = ?', (participant,))
+        log.info(f"Cleared stored events for Participant {participant}; starting a full resync.")
+        return self.sync(participant)
+
+    # Remove Participants that are no longer enrolled in any Study and reclaim the space once enough pages are free.
+    def compact(self, participants, max_free_ratio=0.2):
+        if len(participants) == 0:
+            log.warning("Not compacting the event store without any enrolled Participants.")
+            return 0
+        db = self.connection()
+        with db:
+            db.execute('CREATE TEMP TABLE IF NOT EXISTS live_participants (participant TEXT PRIMARY KEY)')
+            db.execute('DELETE FROM live_participants')
+            db.executemany('INSERT OR IGNORE INTO live_participants (participant) VALUES (?)', [(x,) for x in participants])
+            removed = 0
+            for table in ['activity_events', 'sync_state', 'participant_state', 'specs']:
+                removed += db.execute(f"DELETE FROM {table} WHERE participant NOT IN (SELECT participant FROM live_participants)").rowcount
+            db.execute('DELETE FROM summary_tokens WHERE expires <= ?', (int(time.time() * 1000),))
+        free_pages = db.execute('PRAGMA freelist_count').fetchone()[0]
+        total_pages = db.execute('PRAGMA page_count').fetchone()[0]
+        if total_pages > 0 and free_pages / total_pages > max_free_ratio:
+            db.execute('VACUUM')
+            log.info(f"Compacted the event store at {self.path} ({free_pages} of {total_pages} pages were free).")
+        db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return removed
@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import random
+import pstats
+import logging
+import cProfile
+import threading
+from functools import wraps
+
+log = logging.getLogger(__name__)
+
+# Helper class that traces each unit of work (i.e. one Participant) of an automations worker pass.
+# A trace splits the work into consecutive phases with mark(), and the LAMP API calls made meanwhile are attributed to
+# it (per operation) by its middleware (see api.install). When the pass is closed, the slowest traces are written to
+# a JSON report. With a profile directory, the wrapped work is also run under cProfile (in every thread, or only for a
+# sampled fraction of the units) and the merged profile is dumped next to the report for offline analysis, i.e. with
+# `python -m pstats <file>` or snakeviz.
+class Tracer:
+    def __init__(self, report_path=None, top=20, profile_dir=None, profile_sample=1.0):
+        self.report_path = report_path
+        self.top = top
+        self.profile_dir = profile_dir
+        self.profile_sample = profile_sample
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.traces = []
+        self.profiles = []
+        self.started = None
+
+    def open(self):
+        with self.lock:
+            self.traces, self.profiles = [], []
+            self.started = time.time()
+
+    # Wrap a function so that each call is traced under the name returned by name(*args).
+    def collect(self, function, name):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            profile = None
+            if self.profile_dir is not None and random.random() < self.profile_sample:
+                profile = cProfile.Profile()
+            trace = {'name': name(*args), 'outcome': 'ok', 'seconds': 0.0, 'phases': {}, 'api': {}}
+            self.local.trace, self.local.phase = trace, (None, time.perf_counter())
+            started = time.perf_counter()
+            try:
+                if profile is not None:
+                    try:
+                        profile.enable()
+                    except ValueError:
+                        profile = None # Another profiler is already active (i.e. the worker is run under one).
+                return function(*args, **kwargs)
+            except:
+                trace['outcome'] = 'failed'
+                raise
+            finally:
+                if profile is not None:
+                    profile.disable()
+                self.mark(None)
+                trace['seconds'] = time.perf_counter() - started
+                self.local.trace = None
+                with self.lock:
+                    self.traces.append(trace)
+                    if profile is not None:
+                        self.profiles.append(profile)
+        return wrapper
+
+    # End the current phase of this thread's trace (if any) and start the next one; phases may be entered repeatedly.
+    def mark(self, phase):
+        trace = getattr(self.local, 'trace', None)
+        if trace is None:
+            return
+        name, started = self.local.phase
+        now = time.perf_counter()
+        if name is not None:
+            trace['phases'][name] = trace['phases'].get(name, 0.0) + (now - started)
+        self.local.phase = (phase, now)
+
+    # Middleware (see api.install) that adds each LAMP API call to this thread's trace.
+    def instrument(self, operation, function, args, kwargs):
+        trace = getattr(self.local, 'trace', None)
+        if trace is None:
+            return function(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            calls = trace['api'].setdefault(operation, {'calls': 0, 'seconds': 0.0})
+            calls['calls'] += 1
+            calls['seconds'] += time.perf_counter() - started
+
+    # Write the report (and the profile) of the pass and return the slowest traces.
+    def close(self, outcome='ok'):
+        with self.lock:
+            traces, profiles = self.traces, self.profiles
+            self.traces, self.profiles = [], []
+        slowest = sorted(traces, key=lambda x: x['seconds'], reverse=True)[:self.top]
+        durations = sorted(x['seconds'] for x in traces)
+        report = {
+            'started': self.started,
+            'outcome': outcome,
+            'traced': len(traces),
+            'seconds_total': sum(durations),
+            'seconds_p50': durations[len(durations) // 2] if len(durations) > 0 else None,
+            'seconds_max': durations[-1] if len(durations) > 0 else None,
+            'slowest': slowest,
+        }
+        if self.report_path is not None:
+            try:
+                with open(self.report_path + '.tmp', 'w') as f:
+                    json.dump(report, f, indent=2)
+                os.replace(self.report_path + '.tmp', self.report_path)
+            except:
+                log.exception(f"Could not write the trace report to {self.report_path}.")
+        if len(slowest) > 0:
+            log.info(f"Slowest of {len(traces)} traces: {slowest[0]['name']} took {slowest[0]['seconds']:.2f}s ({', '.join(f'{k} {v:.2f}s' for k, v in slowest[0]['phases'].items())}).")
+        if len(profiles) > 0:
+            try:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                path = os.path.join(self.profile_dir, f"pass-{int(self.started or time.time())}.prof")
+                stats = pstats.Stats(profiles[0])
+                for profile in profiles[1:]:
+                    stats.add(profile)
+                stats.dump_stats(path)
+                log.info(f"Wrote the profile of {len(profiles)} traces to {path}.")
+            except:
+                log.exception(f"Could not write the profile to {self.profile_dir}.")
+        return slowest
@@ -0,0 +1,27 @@
+import signal
+import logging
+import threading
+from main import automations_scheduler, SCHEDULER_MIN_INTERVAL
+from metrics import replace_process
+
+log = logging.getLogger(__name__)
+
+# Driver code to run the automations worker continuously in its own process, separately from the web server.
+# Failed checks are already retried by the scheduler itself; if it stops unexpectedly, it is logged and restarted after
+# a short delay instead of exiting, so a restarting container does not immediately hammer the platform again.
+# SIGTERM (i.e. `docker stop`) and SIGINT let the running checks finish and exit normally, so that the atexit hooks
+# still deliver queued pushes and write back the outbox and registries.
+if __name__ == '__main__':
+    replace_process('worker')
+    stopped = threading.Event()
+    def stop(signum, frame):
+        log.info(f"Received {signal.Signals(signum).name}; stopping the automations worker.")
+        stopped.set()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while not stopped.is_set():
+        try:
+            automations_scheduler(stopped)
+        except Exception:
+            log.exception(f"Automations scheduler stopped unexpectedly; restarting in {SCHEDULER_MIN_INTERVAL}s.")
+        stopped.wait(SCHEDULER_MIN_INTERVAL)